@@ -1,125 +1,343 @@
+import argparse
 import logging
 import os
+import socket
 import sys
 import threading
+import uuid
+import httpx
 import openai
 import json
 import time
 import random
 from datetime import datetime
-from flask import Flask, render_template, request, jsonify, url_for
+from flask import Flask, g, render_template, request, jsonify, url_for
+from jinja2 import ChoiceLoader, FileSystemLoader, PrefixLoader
 from dotenv import load_dotenv
-from test_runner import TestRunner
-from queue import Queue
-from threading import Thread, Lock
+from test_runner import PerformanceBudget, TestRunner
+from llm_proxy import LLMProxy, create_asgi_app
+from model_routing import ModelRouter
+from page_optimizer import PageOptimizer
+from prefetch import PrefetchPools
+from profiling import Profiler
+from jobs import Deadline, JobCancelled, JobTracker, job_event, job_stage
+from log_pipeline import move_console_to_file, setup_logging
+from repair import RepairContext, GenerationStats
+from state_store import LocalStateStore, create_state_store
 from typing import List, Tuple
+from urllib.parse import urlparse
 
 
 load_dotenv()
 
-logging.basicConfig(level=logging.DEBUG)
+# Log records go through a bounded queue to a writer thread, tagged with the job id
+log_listener = setup_logging(
+    level=getattr(logging, os.getenv("DDD_LOG_LEVEL", "DEBUG").upper()),
+    max_chars=int(os.getenv("DDD_LOG_MAX_CHARS", "2000")),
+    debug_per_second=int(os.getenv("DDD_LOG_DEBUG_PER_SECOND", "50")),
+    json_format=os.getenv("DDD_LOG_FORMAT", "text") == "json",
+    log_file=os.getenv("DDD_LOG_FILE"),
+)
 logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
+# Largest request body accepted, by Flask and by the ASGI front
+app.config["MAX_CONTENT_LENGTH"] = int(os.getenv("DDD_MAX_BODY_BYTES", "1048576"))
 log = logging.getLogger("werkzeug")
 log.disabled = True
 
-test_runner = TestRunner()
-
 # Set the OpenAI API key
 api_key = os.getenv("OPENAI_API_KEY")
 if not api_key:
     raise ValueError("OPENAI_API_KEY not found in environment variables")
 client = openai.OpenAI(api_key=api_key)  # instantiate client with API key
 
-# Data structure to store prompts and page mappings
-# This dictionary maps page_name -> {"prompt": ..., "timestamp": ...}
+# Model, max_tokens and timeout per pipeline stage and proxy endpoint
+model_router = ModelRouter.from_file(os.getenv("DDD_MODEL_ROUTES", "model_routes.json"))
+
+# Async client and event loop for the LLM proxy endpoints used by generated pages,
+# with background-filled response pools for requests pages repeat on load
+llm_proxy = LLMProxy(
+    api_key,
+    model_router,
+    max_concurrency=int(os.getenv("LLM_PROXY_MAX_CONCURRENCY", "64")),
+    prefetch=PrefetchPools(
+        depth=int(os.getenv("PREFETCH_DEPTH", "3")),
+        token_budget=int(os.getenv("PREFETCH_TOKEN_BUDGET", "200000")),
+        idle_seconds=float(os.getenv("PREFETCH_IDLE_SECONDS", "900")),
+    ),
+)
+
+# Page metadata seed file for the single-process backend
+# This maps page_name -> {"prompt": ..., "timestamp": ...}
 metadata_file = "page_metadata.json"
 
-# Queue for storing prompts
-prompt_queue = Queue()
-queue_lock = Lock()
-is_processing = False
+# Shared state: prompt queue, page metadata and page storage.
+# DDD_STATE_BACKEND=local keeps everything in this process (the default);
+# DDD_STATE_BACKEND=sqlite lets several web/worker processes share it.
+pages_dir = os.getenv(
+    "DDD_PAGES_DIR", os.path.join(app.root_path, "templates", "pages")
+)
+state = create_state_store(
+    os.getenv("DDD_STATE_BACKEND", "local"),
+    pages_dir,
+    metadata_file,
+    os.getenv("DDD_STATE_DB", "state.sqlite3"),
+)
+
+# Serve "pages/<name>.html" from the (possibly shared) pages directory
+app.jinja_loader = ChoiceLoader(
+    [PrefixLoader({"pages": FileSystemLoader(state.pages_dir)}), app.jinja_loader]
+)
+
+# Workers load test pages through a web node, which may be another process.
+# Pages are also watched for a few seconds against a runtime performance
+# budget; DDD_PERF_BUDGET holds JSON overrides, e.g. {"max_dom_nodes": 8000}
+test_runner = TestRunner(
+    pages_dir=state.pages_dir,
+    base_url=os.getenv("DDD_TEST_BASE_URL", "http://localhost:5000"),
+    performance=(
+        PerformanceBudget(**json.loads(os.getenv("DDD_PERF_BUDGET", "{}")))
+        if os.getenv("DDD_PERF_GATE", "1") != "0"
+        else None
+    ),
+)
+
+# How long a worker owns a claimed prompt before another worker may take it
+lease_seconds = float(os.getenv("DDD_LEASE_SECONDS", "120"))
+
+# Attempts per successful page and wall-clock per job
+generation_stats = GenerationStats()
+
+# Job records with per-stage events, shared through the state store
+job_tracker = JobTracker(state)
+
+# End-to-end time limit for one generation job, across all attempts
+job_deadline_seconds = float(os.getenv("DDD_JOB_DEADLINE", "300"))
+
+# On-demand sampling profiler for selected routes and jobs, off until enabled
+profiler = Profiler(
+    output_dir=os.getenv("DDD_PROFILE_DIR", "profiles"),
+    interval=float(os.getenv("DDD_PROFILE_INTERVAL_MS", "5")) / 1000,
+)
+
+# Save-time minification and size budget for generated pages
+page_optimizer = PageOptimizer(
+    byte_budget=int(os.getenv("PAGE_BYTE_BUDGET", "60000")),
+    inline_max_bytes=int(os.getenv("PAGE_INLINE_MAX_BYTES", "16384")),
+    enabled=os.getenv("PAGE_OPTIMIZE", "1") != "0",
+)
+
+
+def enqueue_prompt(prompt: str, source: str, replaces: str = None) -> Tuple[str, int]:
+    """
+    Create a job for a prompt, queue it and return (job id, queue position).
+    With `replaces`, that page is retired once the new one is saved.
+    """
+    job = job_tracker.create(prompt, source)
+    item = {"prompt": prompt, "source": source, "job_id": job["id"]}
+    if replaces:
+        item["replaces"] = replaces
+    state.enqueue(item)
+    return job["id"], state.queue_size()
 
 
-def process_queue():
-    global is_processing
-    while True:
-        try:
-            if not prompt_queue.empty():
-                with queue_lock:
-                    is_processing = True
-                    prompt = prompt_queue.get()
+def retire_page(page_name: str, replacement: str):
+    """Remove a page and its metadata after a regenerated page took its place."""
+    state.delete_page(page_name)
+    state.delete_page_info(page_name)
+    logger.info(f"Page {page_name} replaced by {replacement}")
 
-                sys.stdout.write(f"\nProcessing prompt: {prompt}\n")
-                sys.stdout.flush()
 
-                success, result = create_page(prompt)
+# Deadline.cancel() reason when another worker has taken over the queue item
+LEASE_LOST = "lease lost to another worker"
 
-                if success:
-                    sys.stdout.write(f"\nSuccess! Page created: {result}\n")
-                    sys.stdout.write("A new button has been added to the index page.\n")
-                else:
-                    sys.stdout.write(f"\nError: {result}\n")
-                sys.stdout.flush()
 
-                with queue_lock:
-                    prompt_queue.task_done()
-                    is_processing = False
-            else:
-                time.sleep(0.1)  # Prevent CPU spinning
+def watch_job(
+    job_id: str,
+    deadline: Deadline,
+    done: threading.Event,
+    lease_lost: threading.Event = None,
+):
+    """
+    Cancel a running job when it is cancelled elsewhere, runs out of time or
+    its queue item has been handed to another worker.
+    """
+    while not done.wait(0.5):
+        if lease_lost is not None and lease_lost.is_set():
+            deadline.cancel(LEASE_LOST)
+            return
+        if state.is_cancel_requested(job_id):
+            deadline.cancel("cancelled by request")
+            return
+        if deadline.remaining() <= 0:
+            deadline.cancel(f"deadline of {deadline.seconds:.0f}s exceeded")
+            return
+
+
+def run_job(
+    job_id: str,
+    prompt: str,
+    replaces: str = None,
+    lease_lost: threading.Event = None,
+) -> Tuple[bool, str]:
+    """
+    Run create_page for a job inside its trace context and deadline. If
+    `lease_lost` is set the job stops and leaves its record to the worker
+    that now holds the queue item.
+    """
+    with job_tracker.trace(job_id), profiler.profile_job(job_id):
+        if state.is_cancel_requested(job_id):
+            job = job_tracker.get(job_id)
+            if job is not None and job["status"] != "cancelled":
+                job_tracker.update(
+                    job_id,
+                    "cancelled before start",
+                    status="cancelled",
+                    error="cancelled",
+                )
+            return False, "Job cancelled before it started"
+
+        deadline = Deadline(job_deadline_seconds)
+        # A per-job HTTP client lets cancellation tear down in-flight OpenAI calls
+        http_client = httpx.Client()
+        remove_close = deadline.add_callback(http_client.close)
+        done = threading.Event()
+        threading.Thread(
+            target=watch_job, args=(job_id, deadline, done, lease_lost), daemon=True
+        ).start()
+
+        job_tracker.update(
+            job_id,
+            f"generation started, deadline {job_deadline_seconds:.0f}s",
+            status="running",
+        )
+        try:
+            success, result = create_page(
+                prompt,
+                deadline=deadline,
+                llm_client=client.with_options(http_client=http_client),
+            )
+            if not success and deadline.cancelled:
+                raise JobCancelled(deadline.reason)
+        except JobCancelled as e:
+            if lease_lost is not None and lease_lost.is_set():
+                return False, f"Job stopped: {e}"
+            job_tracker.update(job_id, str(e), status="cancelled", error=str(e))
+            return False, f"Job cancelled: {e}"
         except Exception as e:
-            logger.error(f"Error in queue processing: {e}")
-            with queue_lock:
-                is_processing = False
-            time.sleep(1)  # Brief pause before continuing
+            job_tracker.update(job_id, str(e), status="failed", error=str(e))
+            raise
+        finally:
+            done.set()
+            remove_close()
+            http_client.close()
 
+        if success:
+            if replaces:
+                retire_page(replaces, result)
+            job_tracker.update(
+                job_id,
+                f"saved as {result}" + (f", replacing {replaces}" if replaces else ""),
+                status="succeeded",
+                page_name=result,
+            )
+        else:
+            job_tracker.update(job_id, result, status="failed", error=result)
+        return success, result
+
+
+def cancel_job(job_id: str) -> bool:
+    """Request cancellation of a queued or running job; False if it is unknown or done."""
+    job = job_tracker.get(job_id)
+    if job is None or job["status"] not in ("queued", "running"):
+        return False
+    state.request_cancel(job_id)
+    if job["status"] == "queued":
+        # Shown as cancelled now; the worker drops it when it gets to it
+        job_tracker.update(
+            job_id, "cancelled while queued", status="cancelled", error="cancelled"
+        )
+    return True
 
-def get_queue_status() -> Tuple[int, bool]:
-    """Returns (number of items in queue, whether processing is active)"""
-    with queue_lock:
-        return prompt_queue.qsize(), is_processing
 
+def keep_lease(
+    item_id: str, worker_id: str, done: threading.Event, lost: threading.Event
+):
+    """Renew a claimed item's lease until the worker finishes with it."""
+    while not done.wait(lease_seconds / 3):
+        if not state.renew_lease(item_id, worker_id, lease_seconds):
+            logger.warning(f"Lost lease on queue item {item_id}, stopping its job")
+            lost.set()
+            return
 
-def load_metadata():
-    """Load page metadata from a JSON file."""
-    if not os.path.exists(metadata_file):
-        return {}
-    with open(metadata_file, "r", encoding="utf-8") as f:
-        return json.load(f)
 
+def process_queue(worker_id: str):
+    while True:
+        try:
+            claimed = state.claim(worker_id, lease_seconds)
+            if claimed is None:
+                time.sleep(state.poll_interval)  # Prevent CPU spinning
+                continue
 
-def save_metadata(metadata):
-    """Save page metadata to a JSON file."""
-    with open(metadata_file, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=4)
+            item_id, item = claimed
+            prompt = item["prompt"]
+            job_id = (
+                item.get("job_id") or job_tracker.create(prompt, item["source"])["id"]
+            )
+            done, lease_lost = threading.Event(), threading.Event()
+            threading.Thread(
+                target=keep_lease,
+                args=(item_id, worker_id, done, lease_lost),
+                daemon=True,
+            ).start()
 
+            try:
+                logger.info(f"Processing prompt [{job_id}]: {prompt}")
 
-page_metadata = load_metadata()
+                success, result = run_job(
+                    job_id, prompt, item.get("replaces"), lease_lost
+                )
+
+                if success:
+                    logger.info(
+                        f"Success! Page created: {result}. "
+                        "A new button has been added to the index page."
+                    )
+                else:
+                    logger.error(f"Job {job_id} failed: {result}")
+            finally:
+                done.set()
+                state.complete(item_id, worker_id)
+        except Exception as e:
+            logger.error(f"Error in queue processing: {e}")
+            time.sleep(1)  # Brief pause before continuing
 
 
-def store_page_info(page_name, prompt):
-    """Store page information in the metadata dictionary and file."""
-    page_metadata[page_name] = {
-        "prompt": prompt,
-        "timestamp": time.time(),  # store timestamp as a float
-    }
-    save_metadata(page_metadata)
+def get_queue_status() -> Tuple[int, bool]:
+    """Returns (number of items in queue, whether processing is active)"""
+    return state.queue_size(), state.processing_count() > 0
+
+
+def store_page_info(page_name, prompt, **extra):
+    """Store page information in the shared metadata store."""
+    state.store_page_info(
+        page_name,
+        {
+            "prompt": prompt,
+            "timestamp": time.time(),  # store timestamp as a float
+            **extra,
+        },
+    )
 
 
 def get_page_info(page_name):
-    """Retrieve page information from the metadata dictionary."""
-    return page_metadata.get(page_name, {"prompt": None, "timestamp": None})
+    """Retrieve page information from the shared metadata store."""
+    return state.get_page_info(page_name) or {"prompt": None, "timestamp": None}
 
 
 def get_available_pages():
-    pages_dir = os.path.join(app.root_path, "templates", "pages")
-    if not os.path.exists(pages_dir):
-        os.makedirs(pages_dir)
-    pages = [
-        f.replace(".html", "") for f in os.listdir(pages_dir) if f.endswith(".html")
-    ]
-    return pages
+    return state.list_pages()
 
 
 @app.route("/api/sms/webhook", methods=["POST"])
@@ -137,11 +355,11 @@ def sms_webhook():
             return "OK", 200
 
         # Add the message to our existing queue
-        prompt_queue.put(message)
+        job_id, position = enqueue_prompt(message, source="sms")
 
         # Log the incoming message
         logger.info(
-            f"SMS Received - From: {from_number}, Message: {message}, Queue Position: {prompt_queue.qsize()}"
+            f"SMS Received - From: {from_number}, Message: {message}, Job: {job_id}, Queue Position: {position}"
         )
 
         # Always return OK to the SMS service
@@ -170,13 +388,16 @@ def datetimeformat_filter(value):
 @app.route("/")
 def index():
     pages = get_available_pages()
+    # One metadata read per request rather than one per page
+    metadata = state.all_page_info()
+    empty = {"prompt": None, "timestamp": None}
     # Sort pages by timestamp if available for chronological order
     sorted_pages = sorted(
-        pages, key=lambda p: get_page_info(p)["timestamp"] or 0, reverse=True
+        pages, key=lambda p: metadata.get(p, empty)["timestamp"] or 0, reverse=True
     )
     page_info_list = []
     for p in sorted_pages:
-        info = get_page_info(p)
+        info = metadata.get(p, empty)
         page_info_list.append(
             {"name": p, "prompt": info["prompt"], "timestamp": info["timestamp"]}
         )
@@ -187,9 +408,7 @@ def index():
 def serve_page(page_name):
     """Serve the dynamically generated page."""
     # Ensure the requested file exists
-    pages_dir = os.path.join(app.root_path, "templates", "pages")
-    page_path = os.path.join(pages_dir, f"{page_name}.html")
-    if not os.path.exists(page_path):
+    if not state.page_exists(page_name):
         return "Page not found", 404
     return render_template(f"pages/{page_name}.html")
 
@@ -199,100 +418,205 @@ def generate_page_endpoint():
     """Dedicated endpoint for page generation"""
     data = request.get_json()
     prompt = data.get("prompt", "")
-    try:
-        success, result = create_page(prompt)
-        if success:
-            return jsonify({"success": True, "page_name": result})
-        else:
-            return jsonify({"success": False, "error": result}), 400
-    except Exception as e:
-        logger.error(f"Page generation error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+    if not prompt:
+        return jsonify({"success": False, "error": "Missing prompt"}), 400
+    # An existing page (file or metadata entry) the new page takes over from
+    replaces = data.get("replaces")
+    if replaces and not (
+        replaces in state.list_pages() or state.get_page_info(replaces)
+    ):
+        return jsonify({"success": False, "error": "Unknown page to replace"}), 404
+    # Queue the job and hand back a handle instead of generating in the request
+    job_id, position = enqueue_prompt(prompt, source="api", replaces=replaces)
+    return (
+        jsonify(
+            {
+                "success": True,
+                "job_id": job_id,
+                "queue_position": position,
+                "status_url": url_for("job_endpoint", job_id=job_id),
+                "cancel_url": url_for("cancel_job_endpoint", job_id=job_id),
+            }
+        ),
+        202,
+    )
 
 
-@app.route("/api/llm/interact", methods=["POST"])
-def llm_interaction_endpoint():
-    data = request.get_json()
+@app.route("/api/jobs/<job_id>")
+def job_endpoint(job_id):
+    """Full record of one job, including its timestamped stage events."""
+    job = job_tracker.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify({"success": True, "job": job})
 
-    # Enforce required fields
-    if not data.get("role") or not data.get("prompt"):
-        return jsonify({"success": False, "error": "Missing required fields"}), 400
 
-    try:
-        # Parse expected response type
-        expected_type = data.get("expect", "text")  # text, list, or json
-
-        # Build system message based on expected type
-        system_message = f"""You are {data['role']}. 
-You must respond in this exact format:
-{expected_type=='text' and 'A single text string' or 
- expected_type=='list' and 'A JSON array of strings' or 
- expected_type=='json' and 'A JSON object matching the provided schema'}
-"""
+@app.route("/api/jobs/<job_id>/cancel", methods=["POST"])
+def cancel_job_endpoint(job_id):
+    """Cancel a queued or running job; a running job stops within a second."""
+    if not cancel_job(job_id):
+        return jsonify({"success": False, "error": "No queued or running job"}), 404
+    return jsonify({"success": True, "job_id": job_id}), 202
 
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": data["prompt"]},
-            ],
-            temperature=data.get("temperature", 0.7),
-        )
 
-        result = response.choices[0].message.content.strip()
+@app.route("/api/jobs")
+def jobs_endpoint():
+    """
+    Recently updated jobs. With `since` (a previous response's `now`) only
+    jobs changed after it are returned.
 
-        # Validate and parse response based on expected type
-        if expected_type == "json":
-            try:
-                result = json.loads(result)
-            except:
-                return jsonify(
-                    {"success": False, "error": "Invalid JSON response"}
-                ), 500
-        elif expected_type == "list":
-            try:
-                result = json.loads(result)
-                if not isinstance(result, list):
-                    raise ValueError("Not a list")
-            except:
-                return jsonify(
-                    {"success": False, "error": "Invalid list response"}
-                ), 500
+    A `wait` long-poll is done by the async server before the request gets
+    here, without holding a thread. If `wait` is still present the app is
+    served by waitress, where waiting would tie up one of its few threads,
+    so the request returns at once and tells the client when to poll again.
+    """
+    limit = min(request.args.get("limit", 20, type=int), 100)
+    since = request.args.get("since", type=float)
+    result = {
+        "success": True,
+        "now": time.time(),
+        "jobs": job_tracker.recent(limit, since),
+    }
+    if "wait" in request.args:
+        result["poll_after"] = 3
+    return jsonify(result)
 
-        return jsonify({"success": True, "data": result})
 
-    except Exception as e:
-        logger.error(f"LLM interaction error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+@app.route("/api/stats/generation")
+def generation_stats_endpoint():
+    """Attempts per successful page and wall-clock per job since startup."""
+    return jsonify(generation_stats.snapshot())
+
+
+@app.route("/api/stats/routes")
+def route_stats_endpoint():
+    """Latency and pass rate per (stage, model) route since startup."""
+    return jsonify(model_router.stats())
+
+
+@app.before_request
+def start_request_profile():
+    if profiler.routes and profiler.wants_route(request.endpoint):
+        g.profile = profiler.start(f"route-{request.endpoint}")
+
+
+@app.teardown_request
+def stop_request_profile(exc=None):
+    session = g.pop("profile", None)
+    if session is not None:
+        profiler.stop(session)
+
+
+@app.route("/api/profiling", methods=["GET", "POST"])
+def profiling_endpoint():
+    """
+    Show or change what is profiled. POST a JSON object with any of:
+    "routes": {endpoint: rate} (rate 0 stops), "jobs": rate,
+    "job_ids": [job id, ...], "interval_ms": number, "reset": true.
+    """
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        try:
+            if data.get("reset"):
+                profiler.reset()
+            for endpoint, rate in (data.get("routes") or {}).items():
+                if endpoint not in app.view_functions:
+                    return jsonify(
+                        {"success": False, "error": f"Unknown endpoint: {endpoint}"}
+                    ), 400
+                profiler.set_route(endpoint, float(rate))
+            if "jobs" in data:
+                profiler.set_jobs(float(data["jobs"]))
+            for job_id in data.get("job_ids") or []:
+                profiler.add_job(str(job_id))
+            if "interval_ms" in data:
+                profiler.interval = max(0.001, float(data["interval_ms"]) / 1000)
+        except (TypeError, ValueError) as e:
+            return jsonify({"success": False, "error": f"Invalid request: {e}"}), 400
+        logger.info(f"Profiling settings changed: {data}")
+    return jsonify({"success": True, **profiler.status()})
+
+
+@app.route("/api/stats/prefetch")
+def prefetch_stats_endpoint():
+    """Prefetch pool sizes, hit rate and background token spend."""
+    return jsonify(llm_proxy.run(llm_proxy.prefetch_stats()))
+
+
+def referer_path() -> str:
+    """Path of the page that made the current request, if the browser sent it."""
+    return urlparse(request.referrer).path if request.referrer else None
+
+
+@app.route("/api/llm/interact", methods=["POST"])
+def llm_interaction_endpoint():
+    # Only reached when serving with waitress; the async server answers
+    # this route on the proxy event loop without holding a WSGI thread
+    result, status = llm_proxy.run(
+        llm_proxy.interact(request.get_json(), referer_path())
+    )
+    return jsonify(result), status
 
 
 @app.route("/api/llm/page", methods=["POST"])
 def page_llm_endpoint():
     """Simple endpoint for generated pages to interact with LLM"""
-    data = request.get_json()
-    try:
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "You are " + data.get("role", "a helpful AI assistant."),
-                },
-                {"role": "user", "content": data.get("prompt", "")},
-            ],
-            temperature=data.get("temperature", 0.7),
-            max_tokens=data.get("max_tokens", 4096),
-            n=1,
-        )
-        return jsonify(
-            {"success": True, "data": response.choices[0].message.content.strip()}
-        )
-    except Exception as e:
-        logger.error(f"Page LLM interaction error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+    result, status = llm_proxy.run(llm_proxy.page(request.get_json(), referer_path()))
+    return jsonify(result), status
+
+
+def extract_html(content: str) -> str:
+    """Strip surrounding whitespace and any ```html fence from a completion."""
+    content = content.strip()
+    if "```html" in content:
+        content = content.split("```html")[1].split("```")[0].strip()
+    return content
+
+
+def ensure_page_structure(page_content: str) -> str:
+    """Patch in the DOCTYPE, <head> and meta tags the test runner requires."""
+    if not page_content.startswith("<!DOCTYPE html>"):
+        page_content = "<!DOCTYPE html>\n" + page_content
 
+    if "<head>" not in page_content:
+        page_content = page_content.replace("<html>", "<html>\n<head></head>")
+
+    head_end = page_content.find("</head>")
+    if head_end != -1:
+        meta_tags = ""
+        if '<meta charset="UTF-8">' not in page_content:
+            meta_tags += '<meta charset="UTF-8">\n'
+        if '<meta name="viewport"' not in page_content:
+            meta_tags += '<meta name="viewport" content="width=device-width, initial-scale=1.0">\n'
+        page_content = page_content[:head_end] + meta_tags + page_content[head_end:]
+    return page_content
+
+
+def create_page(
+    prompt: str, deadline: Deadline = None, llm_client: openai.OpenAI = None
+) -> tuple[bool, str]:
+    """
+    Generate, analyze, fix and test a page for a prompt, repairing the best
+    candidate on retries. With a deadline every stage checks it, OpenAI
+    calls and the browser test get the remaining time as their timeout, and
+    JobCancelled is raised once the job is cancelled or out of time.
+    """
+    llm_client = llm_client or client
+
+    def complete(stage, messages, **kwargs):
+        """Routed completion bounded by the job's remaining time."""
+        if deadline is None:
+            return model_router.complete(llm_client, stage, messages, **kwargs)
+        deadline.check(stage)
+        return deadline.run(
+            model_router.complete,
+            llm_client,
+            stage,
+            messages,
+            timeout=deadline.remaining(),
+            **kwargs,
+        )
 
-def create_page(prompt: str) -> tuple[bool, str]:
     system_message = """
 You are a tool that generates HTML pages with inline CSS and JS based made to fulfill the request of the user prompt. You will as per the rules something that will be a complete fully functional page, each part of it must be fully implemented and working; if the user's request via prompt is too large to handle easily, you need to be creative and find a way to meet the demands to make it still work somehow, even if you have to be cheeky about it. You can use the LLM integration if the user asks for it or for something that logically should be handled by the LLM. You will follow these strict rules:
 
@@ -534,6 +858,33 @@ If a requested feature is too complex:
 3. Break complex features into core + optional parts
 4. Prioritize working functionality over complexity
 
+Your response must be ONLY the complete, working HTML page."""
+
+    repair_message = """You are a surgical code repairer. A previous attempt at this page failed. Your response must be a complete HTML page (max 4000 tokens).
+
+Original Request: {prompt}
+
+Errors reported so far (analyzer and browser test):
+{errors}
+
+Attempt history:
+{history}
+
+RESPONSE FORMAT:
+<!DOCTYPE html>
+<html>
+... complete working page ...
+</html>
+
+RULES:
+1. The user message is the best candidate so far - repair it, do not start over
+2. Fix every error listed above, most recent first
+3. Preserve all working code, structure and variable names
+4. Do not reintroduce errors that were already fixed in earlier attempts
+5. Stay within 4000 tokens; simplify a feature rather than leave it broken
+6. No TODOs or placeholders - everything must work
+7. Include all required elements (app, content, loader, error)
+
 Your response must be ONLY the complete, working HTML page."""
 
     user_message_content = (
@@ -542,131 +893,253 @@ Your response must be ONLY the complete, working HTML page."""
         "Ensure that all functionalities are accurately implemented and will work straight away, there are no second chances.\n"
     )
 
+    context = RepairContext(prompt)
     max_attempts = 5
     for attempt in range(max_attempts):
-        logger.debug(f"Attempt {attempt + 1}/{max_attempts}: Sending prompt to OpenAI")
+        attempt_started = time.monotonic()
+        mode = "repair" if context.has_candidate else "generate"
+        page_content = None
+        issues = []
+        routes_used = []
+        logger.debug(
+            f"Attempt {attempt + 1}/{max_attempts}: Sending prompt to OpenAI ({mode})"
+        )
+        job_event(
+            "attempt",
+            f"attempt {attempt + 1}/{max_attempts}",
+            attempt=attempt,
+            mode=mode,
+        )
 
         try:
-            # Initial page generation
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message_content},
-                ],
-                temperature=0.2,
-                max_tokens=4096,
-                n=1,
-            )
+            if deadline:
+                deadline.check(f"attempt {attempt + 1}")
+
+            if mode == "repair":
+                # Targeted repair of the best candidate so far
+                with job_stage("repair", attempt=attempt) as stage:
+                    content, route = complete(
+                        "repair",
+                        [
+                            {
+                                "role": "system",
+                                "content": repair_message.format(
+                                    prompt=prompt,
+                                    errors=context.error_summary(),
+                                    history=context.history_summary(),
+                                ),
+                            },
+                            {"role": "user", "content": context.best_candidate},
+                        ],
+                        attempt=attempt,
+                        temperature=0.1,
+                    )
+                    stage["model"] = route["model"]
+            else:
+                # Initial page generation
+                with job_stage("generate", attempt=attempt) as stage:
+                    content, route = complete(
+                        "generate",
+                        [
+                            {"role": "system", "content": system_message},
+                            {"role": "user", "content": user_message_content},
+                        ],
+                        attempt=attempt,
+                        temperature=0.2,
+                        n=1,
+                    )
+                    stage["model"] = route["model"]
+            routes_used.append(route)
 
-            page_content = response.choices[0].message.content.strip()
-            if "```html" in page_content:
-                page_content = page_content.split("```html")[1].split("```")[0].strip()
+            page_content = extract_html(content)
+            if mode == "repair" and not page_content.lstrip().lower().startswith(
+                ("<!doctype html>", "<html")
+            ):
+                # The repairer answered with prose - keep working on the best candidate
+                page_content = context.best_candidate
 
             # Analyze the generated code
-            analysis_response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": analysis_message},
-                    {
-                        "role": "user",
-                        "content": f"Original prompt: {prompt}\n\nGenerated code:\n{page_content}",
-                    },
-                ],
-                temperature=0.1,
-                max_tokens=200,
-            )
-
-            analysis_result = (
-                analysis_response.choices[0].message.content.strip().split("\n")
-            )
-            needs_fixes = analysis_result[0].upper() == "TRUE"
-
-            if needs_fixes and len(analysis_result) > 1:
-                issues = analysis_result[1]
-                logger.debug(f"Issues found: {issues}")
-
-                # Fix the issues while preserving working parts
-                fix_response = client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
+            with job_stage("analyze", attempt=attempt) as stage:
+                analysis_content, route = complete(
+                    "analyze",
+                    [
+                        {"role": "system", "content": analysis_message},
                         {
-                            "role": "system",
-                            "content": fix_message.format(prompt=prompt, issues=issues),
+                            "role": "user",
+                            "content": f"Original prompt: {prompt}\n\nGenerated code:\n{page_content}",
                         },
-                        {"role": "user", "content": page_content},
                     ],
+                    attempt=attempt,
                     temperature=0.1,
-                    max_tokens=4096,
                 )
+                stage["model"] = route["model"]
+            routes_used.append(route)
+
+            analysis_result = analysis_content.split("\n")
+            needs_fixes = analysis_result[0].upper() == "TRUE"
 
-                fixed_content = fix_response.choices[0].message.content.strip()
-                if "```html" in fixed_content:
-                    fixed_content = (
-                        fixed_content.split("```html")[1].split("```")[0].strip()
+            if needs_fixes and len(analysis_result) > 1:
+                issues = [i.strip() for i in analysis_result[1].split(",") if i.strip()]
+                logger.debug(f"Issues found: {analysis_result[1]}")
+
+                # Fix the issues while preserving working parts
+                with job_stage("fix", attempt=attempt, issues=len(issues)) as stage:
+                    fix_content, route = complete(
+                        "fix",
+                        [
+                            {
+                                "role": "system",
+                                "content": fix_message.format(
+                                    prompt=prompt, issues=analysis_result[1]
+                                ),
+                            },
+                            {"role": "user", "content": page_content},
+                        ],
+                        attempt=attempt,
+                        temperature=0.1,
                     )
+                    stage["model"] = route["model"]
+                routes_used.append(route)
 
+                fixed_content = extract_html(fix_content)
                 if fixed_content.startswith("<!DOCTYPE html>"):
                     page_content = fixed_content
+                    # The fixer addressed these: remember them for later repairs
+                    # but do not count them against the fixed candidate
+                    for issue in issues:
+                        context.add_error("analysis", attempt, issue)
+                    issues = []
+
+            page_content = ensure_page_structure(page_content)
+
+            # Optimize before testing so the page that is saved is the one tested;
+            # repairs keep working on the readable, un-minified candidate
+            with job_stage("optimize", attempt=attempt) as stage:
+                optimized_content, size_report = page_optimizer.optimize(page_content)
+                stage["original_bytes"] = size_report["original_bytes"]
+                stage["optimized_bytes"] = size_report["optimized_bytes"]
+            logger.debug(
+                f"Page size: {size_report['original_bytes']} -> "
+                f"{size_report['optimized_bytes']} bytes "
+                f"({size_report['css_rules_removed']} unused CSS rules removed)"
+            )
 
-            # Ensure all required elements are present
-            if not page_content.startswith("<!DOCTYPE html>"):
-                page_content = "<!DOCTYPE html>\n" + page_content
-
-            if "<head>" not in page_content:
-                page_content = page_content.replace("<html>", "<html>\n<head></head>")
-
-            head_end = page_content.find("</head>")
-            if head_end != -1:
-                meta_tags = ""
-                if '<meta charset="UTF-8">' not in page_content:
-                    meta_tags += '<meta charset="UTF-8">\n'
-                if '<meta name="viewport"' not in page_content:
-                    meta_tags += '<meta name="viewport" content="width=device-width, initial-scale=1.0">\n'
-                page_content = (
-                    page_content[:head_end] + meta_tags + page_content[head_end:]
-                )
-
-            # Test the final page
-            success, error = test_runner.test_page(page_content)
+            if size_report["error"]:
+                success, error = False, size_report["error"]
+            else:
+                # Test the final page
+                with job_stage("test", attempt=attempt) as stage:
+                    if deadline:
+                        deadline.check("test")
+                    success, error = test_runner.test_page(
+                        optimized_content,
+                        timeout=deadline.remaining() if deadline else None,
+                        on_cancel=deadline.add_callback if deadline else None,
+                    )
+                    stage["passed"] = success
+                    if error:
+                        stage["error"] = error[:500]
+
+                if (
+                    not success
+                    and error.startswith("JavaScript errors:")
+                    and optimized_content != page_content
+                ):
+                    # Only script errors can come from the optimizer (structure,
+                    # timeouts and performance do not); tell a page it broke
+                    # from one that is broken, so its errors never reach the
+                    # repair prompts. The performance window is not repeated.
+                    with job_stage("test-original", attempt=attempt) as stage:
+                        if deadline:
+                            deadline.check("test-original")
+                        original_ok, original_error = test_runner.test_page(
+                            page_content,
+                            timeout=deadline.remaining() if deadline else None,
+                            on_cancel=deadline.add_callback if deadline else None,
+                            check_performance=False,
+                        )
+                        stage["passed"] = original_ok
+                    if original_ok:
+                        logger.warning(
+                            "The optimized page failed its test but the original "
+                            f"passed; saving the original. Optimizer broke: {error}"
+                        )
+                        optimized_content = page_content
+                        size_report["optimized_bytes"] = size_report["original_bytes"]
+                        success, error = True, None
+                    else:
+                        error = original_error
+            model_router.record_outcome(routes_used, success)
+            context.record_attempt(
+                attempt,
+                mode,
+                page_content,
+                issues,
+                None if success else error,
+                attempt_started,
+            )
             if success:
+                if deadline:
+                    # Not if the job was cancelled or its lease lost meanwhile
+                    deadline.check("save")
                 page_name = f"page_{int(time.time())}_{random.randint(1000, 9999)}"
-                pages_dir = os.path.join(app.root_path, "templates", "pages")
-                page_path = os.path.join(pages_dir, f"{page_name}.html")
-                with open(page_path, "w", encoding="utf-8") as f:
-                    f.write(page_content)
+                page_path = state.save_page(page_name, optimized_content)
 
-                logger.info(f"Page successfully created and saved as: {page_path}")
-                store_page_info(page_name, prompt)
+                logger.info(
+                    f"Page successfully created and saved as: {page_path} "
+                    f"({attempt + 1} attempt(s), {context.elapsed():.1f}s, "
+                    f"{size_report['optimized_bytes']} bytes)"
+                )
+                store_page_info(
+                    page_name,
+                    prompt,
+                    attempts=attempt + 1,
+                    generation_seconds=round(context.elapsed(), 2),
+                    size_bytes=size_report["optimized_bytes"],
+                    original_bytes=size_report["original_bytes"],
+                )
+                generation_stats.record(True, attempt + 1, context.elapsed())
                 return True, page_name
             else:
                 logger.warning(
                     f"Attempt {attempt + 1} failed. Error: {error}. Retrying...\n"
                 )
-                if attempt < max_attempts - 1:
-                    user_message_content = (
-                        f"The previous attempt produced an error: {error}\n"
-                        "Please correct these issues and produce the corrected HTML.\n"
-                        f"Original prompt: {prompt}\n"
-                    )
-                else:
+                if attempt == max_attempts - 1:
                     logger.error(
                         f"Failed after {max_attempts} attempts. Last error: {error}"
                     )
+                    generation_stats.record(False, max_attempts, context.elapsed())
                     return (
                         False,
                         f"Failed after {max_attempts} attempts. Last error: {error}",
                     )
 
+        except JobCancelled:
+            generation_stats.record(False, attempt + 1, context.elapsed())
+            raise
         except openai.OpenAIError as e:
             logger.error(f"OpenAI API Error on attempt {attempt + 1}: {e}")
+            context.record_attempt(
+                attempt,
+                mode,
+                page_content,
+                issues,
+                f"OpenAI error: {e}",
+                attempt_started,
+            )
             if attempt == max_attempts - 1:
+                generation_stats.record(False, max_attempts, context.elapsed())
                 return False, f"OpenAI error after {max_attempts} attempts: {str(e)}"
         except Exception as e:
             logger.error(f"General error on attempt {attempt + 1}: {e}")
+            context.record_attempt(
+                attempt, mode, page_content, issues, str(e), attempt_started
+            )
             if attempt == max_attempts - 1:
+                generation_stats.record(False, max_attempts, context.elapsed())
                 return False, str(e)
 
+    generation_stats.record(False, max_attempts, context.elapsed())
     return False, "Unexpected failure to generate a valid page after all attempts."
 
 
@@ -674,6 +1147,13 @@ def prompt_loop():
     sys.stdout.write("\nWeb app is running. Access it at http://localhost:5000\n")
     sys.stdout.write("\nEnter your page descriptions below. Type 'quit' to exit.\n")
     sys.stdout.write("Type 'status' to see the queue status.\n")
+    sys.stdout.write("Type 'stats' to see generation statistics.\n")
+    sys.stdout.write("Type 'jobs' to list recent jobs, 'job <id>' for one job.\n")
+    sys.stdout.write("Type 'cancel <id>' to cancel a queued or running job.\n")
+    sys.stdout.write(
+        "Type 'profile' for profiling: 'profile route <endpoint> [rate]', "
+        "'profile jobs [rate]', 'profile job <id>', 'profile off'.\n"
+    )
     sys.stdout.flush()
 
     while True:
@@ -690,6 +1170,7 @@ def prompt_loop():
             if prompt_input.lower() == "quit":
                 sys.stdout.write("\nShutting down...\n")
                 sys.stdout.flush()
+                log_listener.stop()  # os._exit skips atexit: flush queued logs
                 os._exit(0)
 
             if prompt_input.lower() == "status":
@@ -701,20 +1182,129 @@ def prompt_loop():
                 sys.stdout.flush()
                 continue
 
+            if prompt_input.lower() == "jobs":
+                jobs_msg = "\nRecent jobs:\n"
+                for job in job_tracker.recent(10):
+                    jobs_msg += (
+                        f"{job['id']} {job['status']:<9} {job['stage']:<9} "
+                        f"{job['prompt'][:50]}\n"
+                    )
+                sys.stdout.write(jobs_msg)
+                sys.stdout.flush()
+                continue
+
+            if prompt_input.lower().startswith("job "):
+                job = job_tracker.get(prompt_input[4:].strip())
+                if job is None:
+                    sys.stdout.write("No such job.\n")
+                else:
+                    job_msg = f"\nJob {job['id']} ({job['status']}): {job['prompt']}\n"
+                    for event in job["events"]:
+                        offset = event["time"] - job["created"]
+                        duration = (
+                            f" ({event['duration']}s)" if "duration" in event else ""
+                        )
+                        job_msg += f"  +{offset:7.2f}s {event['stage']}{duration} {event['message']}\n"
+                    sys.stdout.write(job_msg)
+                sys.stdout.flush()
+                continue
+
+            if prompt_input.lower().startswith("cancel "):
+                job_id = prompt_input[7:].strip()
+                if cancel_job(job_id):
+                    sys.stdout.write(f"Cancellation requested for job {job_id}.\n")
+                else:
+                    sys.stdout.write("No queued or running job with that id.\n")
+                sys.stdout.flush()
+                continue
+
+            if prompt_input.lower() == "profile" or prompt_input.lower().startswith(
+                "profile "
+            ):
+                args = prompt_input.split()[1:]
+                try:
+                    if args[:1] == ["off"]:
+                        profiler.reset()
+                    elif args[:1] == ["route"] and len(args) in (2, 3):
+                        if args[1] not in app.view_functions:
+                            raise ValueError(f"unknown endpoint {args[1]}")
+                        profiler.set_route(
+                            args[1], float(args[2]) if len(args) == 3 else 1.0
+                        )
+                    elif args[:1] == ["jobs"] and len(args) in (1, 2):
+                        profiler.set_jobs(float(args[1]) if len(args) == 2 else 1.0)
+                    elif args[:1] == ["job"] and len(args) == 2:
+                        profiler.add_job(args[1])
+                    elif args:
+                        raise ValueError("unknown profile command")
+                except ValueError as e:
+                    sys.stdout.write(f"Profile: {e}\n")
+                    sys.stdout.flush()
+                    continue
+                status = profiler.status()
+                profile_msg = "\nProfiling:\n"
+                for endpoint, rate in status["routes"].items():
+                    profile_msg += f"  route {endpoint}: {rate:.0%} of requests\n"
+                if status["jobs_rate"]:
+                    profile_msg += f"  jobs: {status['jobs_rate']:.0%}\n"
+                for job_id in status["job_ids"]:
+                    profile_msg += f"  next run of job {job_id}\n"
+                if status["active"]:
+                    profile_msg += f"  running: {', '.join(status['active'])}\n"
+                for recent in status["recent"][-5:]:
+                    profile_msg += (
+                        f"  {recent['name']} ({recent['seconds']}s): {recent['path']}\n"
+                    )
+                profile_msg += f"Profiles are written to {status['output_dir']}\n"
+                sys.stdout.write(profile_msg)
+                sys.stdout.flush()
+                continue
+
+            if prompt_input.lower() == "stats":
+                stats = generation_stats.snapshot()
+                stats_msg = "\nGeneration stats:\n"
+                stats_msg += f"Jobs: {stats['jobs']} ({stats['successes']} ok, {stats['failures']} failed)\n"
+                if stats["avg_attempts_per_success"] is not None:
+                    stats_msg += f"Attempts per successful page: {stats['avg_attempts_per_success']:.2f}\n"
+                if stats["avg_seconds_per_job"] is not None:
+                    stats_msg += (
+                        f"Wall-clock per job: {stats['avg_seconds_per_job']:.1f}s\n"
+                    )
+                for name, route_stats in model_router.stats().items():
+                    stats_msg += (
+                        f"  {name}: {route_stats['calls']} calls, "
+                        f"p50 {route_stats['p50_seconds']}s, "
+                        f"p95 {route_stats['p95_seconds']}s, "
+                        f"pass rate {route_stats['pass_rate']}\n"
+                    )
+                prefetch = llm_proxy.run(llm_proxy.prefetch_stats())
+                if prefetch:
+                    stats_msg += (
+                        f"Prefetch: {prefetch['pools']} pools, "
+                        f"{prefetch['buffered']} ready, "
+                        f"hit rate {prefetch['hit_rate']}, "
+                        f"~{prefetch['tokens_in_window']}/{prefetch['token_budget']} "
+                        "tokens this hour\n"
+                    )
+                sys.stdout.write(stats_msg)
+                sys.stdout.flush()
+                continue
+
             if not prompt_input:
                 sys.stdout.write("Please provide a valid prompt.\n")
                 sys.stdout.flush()
                 continue
 
-            prompt_queue.put(prompt_input)
+            job_id, position = enqueue_prompt(prompt_input, source="cli")
             sys.stdout.write(
-                f"Prompt added to queue. Position: {prompt_queue.qsize()}\n"
+                f"Prompt added to queue. Job: {job_id}, Position: {position}\n"
             )
             sys.stdout.flush()
 
         except KeyboardInterrupt:
             sys.stdout.write("\nExiting...\n")
             sys.stdout.flush()
+            log_listener.stop()  # os._exit skips atexit: flush queued logs
             os._exit(0)
         except Exception as e:
             logger.exception("Error in prompt loop.")
@@ -722,18 +1312,109 @@ def prompt_loop():
             sys.stdout.flush()
 
 
+async def wait_for_jobs(params: dict):
+    """Long-poll wait for /api/jobs when served by the async server."""
+    try:
+        since = float(params["since"]) if "since" in params else None
+        wait = min(float(params.get("wait", 0)), 30)
+    except ValueError:
+        return
+    await job_tracker.await_updates(since, wait)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Live page generator")
+    parser.add_argument(
+        "--role",
+        choices=["all", "web", "worker"],
+        default=os.getenv("DDD_ROLE", "all"),
+        help="web serves pages and accepts prompts, worker generates pages",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("DDD_WORKERS", "1")),
+        help="number of generation worker threads (worker and all roles)",
+    )
+    parser.add_argument("--host", default=os.getenv("DDD_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.getenv("DDD_PORT", "5000")))
+    parser.add_argument(
+        "--server",
+        choices=["async", "waitress"],
+        default=os.getenv("DDD_SERVER", "async"),
+        help="async serves the LLM proxy routes on an event loop (needs uvicorn)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=int(os.getenv("DDD_THREADS", "8")),
+        help="threads for the regular (non-LLM) routes",
+    )
+    parser.add_argument(
+        "--no-cli", action="store_true", help="run without the interactive prompt"
+    )
+    return parser.parse_args()
+
+
 if __name__ == "__main__":
     from waitress import serve
 
-    # Start the queue processor thread
-    queue_processor = threading.Thread(target=process_queue, daemon=True)
-    queue_processor.start()
+    args = parse_args()
+    if args.role != "all" and isinstance(state, LocalStateStore):
+        logger.warning(
+            f"Running role '{args.role}' with the local state backend; "
+            "set DDD_STATE_BACKEND=sqlite to share state with other processes"
+        )
 
-    # Start the Flask app in a separate thread
-    flask_thread = threading.Thread(
-        target=lambda: serve(app, host="0.0.0.0", port=5000), daemon=True
-    )
-    flask_thread.start()
+    if args.role in ("all", "worker"):
+        # Start the queue processor threads
+        for i in range(args.workers):
+            worker_id = (
+                f"{socket.gethostname()}:{os.getpid()}:{i}:{uuid.uuid4().hex[:6]}"
+            )
+            queue_processor = threading.Thread(
+                target=process_queue, args=(worker_id,), daemon=True
+            )
+            queue_processor.start()
+
+    if args.role in ("all", "web"):
+        if args.server == "async":
+            import uvicorn
+
+            server = uvicorn.Server(
+                uvicorn.Config(
+                    create_asgi_app(
+                        llm_proxy,
+                        app,
+                        threads=args.threads,
+                        long_polls={"/api/jobs": wait_for_jobs},
+                        max_body=app.config["MAX_CONTENT_LENGTH"],
+                    ),
+                    host=args.host,
+                    port=args.port,
+                    lifespan="off",
+                    access_log=False,
+                    # Use the app's logging pipeline instead of uvicorn's handlers
+                    log_config=None,
+                )
+            )
+            target = server.run
+        else:
+            target = lambda: serve(
+                app, host=args.host, port=args.port, threads=args.threads
+            )
 
-    # Run the prompt loop in the main thread
-    prompt_loop()
+        # Start the web server in a separate thread
+        flask_thread = threading.Thread(target=target, daemon=True)
+        flask_thread.start()
+
+    if args.no_cli:
+        threading.Event().wait()
+    else:
+        # Logs on stderr would interleave with the prompt, so they go to a file
+        if os.getenv("DDD_LOG_CONSOLE", "0") != "1":
+            log_path = os.getenv("DDD_LOG_FILE") or "ddd.log"
+            move_console_to_file(log_listener, log_path)
+            sys.stdout.write(f"Logging to {os.path.abspath(log_path)}\n")
+        # Run the prompt loop in the main thread
+        prompt_loop()
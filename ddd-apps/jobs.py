@@ -0,0 +1,253 @@
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Callable, List, Optional
+
+from profiling import run_attached
+from state_store import StateStore
+
+logger = logging.getLogger(__name__)
+
+# (tracker, job_id) of the job the current thread or task is working on
+current_job = contextvars.ContextVar("current_job", default=None)
+
+
+def current_job_id() -> Optional[str]:
+    trace = current_job.get()
+    return trace[1] if trace else None
+
+
+def job_event(stage: str, message: str = "", **fields):
+    """Record an event on the current job; a no-op outside a job trace."""
+    trace = current_job.get()
+    if trace:
+        trace[0].event(trace[1], stage, message, **fields)
+
+
+@contextmanager
+def job_stage(stage: str, **fields):
+    """
+    Time a stage of the current job. Records one event when the stage ends,
+    with its duration and whether it raised. The yielded dict can be used to
+    add fields known only once the stage has run (e.g. the model used).
+    """
+    started = time.monotonic()
+    try:
+        yield fields
+    except BaseException as e:
+        job_event(
+            stage,
+            f"failed: {e}",
+            duration=round(time.monotonic() - started, 3),
+            ok=False,
+            **fields,
+        )
+        raise
+    job_event(stage, duration=round(time.monotonic() - started, 3), ok=True, **fields)
+
+
+class JobCancelled(Exception):
+    """Raised inside a job when it is cancelled or its deadline passes."""
+
+
+class Deadline:
+    """
+    End-to-end time limit and cancellation signal for one job.
+
+    Stages call check() between steps and size their own timeouts from
+    remaining(). Code holding an abortable resource (an HTTP client, a
+    browser session) registers a callback that cancel() runs from the
+    watcher thread.
+    """
+
+    def __init__(self, seconds: float):
+        self.seconds = seconds
+        self.expires = time.monotonic() + seconds
+        self.reason = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def cancel(self, reason: str):
+        with self._lock:
+            if self._cancelled.is_set():
+                return
+            self.reason = reason
+            self._cancelled.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.debug(f"Cancel callback failed: {e}")
+
+    def check(self, stage: str = ""):
+        if not self._cancelled.is_set() and self.remaining() <= 0:
+            self.cancel(f"deadline of {self.seconds:.0f}s exceeded")
+        if self._cancelled.is_set():
+            where = f" before {stage}" if stage else ""
+            raise JobCancelled(f"{self.reason}{where}")
+
+    def add_callback(self, callback) -> Callable[[], None]:
+        """Run `callback` on cancel; returns a function that unregisters it."""
+        with self._lock:
+            if not self._cancelled.is_set():
+                self._callbacks.append(callback)
+
+                def remove():
+                    with self._lock:
+                        if callback in self._callbacks:
+                            self._callbacks.remove(callback)
+
+                return remove
+        # Already cancelled: abort straight away
+        callback()
+        return lambda: None
+
+    def run(self, fn, *args, **kwargs):
+        """
+        Call a blocking function on a helper thread and return its result,
+        raising JobCancelled as soon as the job is cancelled instead of
+        waiting for the call to finish.
+        """
+        outcome = {}
+        done = threading.Event()
+        context = contextvars.copy_context()
+
+        def target():
+            try:
+                # Stays in the job's profile, if it is being profiled
+                outcome["value"] = context.run(run_attached, fn, *args, **kwargs)
+            except BaseException as e:
+                outcome["error"] = e
+            finally:
+                done.set()
+
+        threading.Thread(target=target, daemon=True).start()
+        while not done.wait(0.1):
+            if self._cancelled.is_set():
+                raise JobCancelled(self.reason)
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["value"]
+
+
+def job_summary(job: dict) -> dict:
+    """A job without its event list, plus its latest event."""
+    summary = {k: v for k, v in job.items() if k != "events"}
+    summary["last_event"] = job["events"][-1] if job["events"] else None
+    return summary
+
+
+class JobTracker:
+    """
+    Creates job records and appends timestamped stage events to them.
+
+    Records live in the state store so any web process can report on jobs
+    a worker elsewhere is running.
+    """
+
+    def __init__(self, store: StateStore, max_events: int = 200):
+        self.store = store
+        self.max_events = max_events
+
+    def create(self, prompt: str, source: str) -> dict:
+        now = time.time()
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "prompt": prompt,
+            "source": source,
+            "status": "queued",
+            "stage": "queued",
+            "attempt": None,
+            "created": now,
+            "updated": now,
+            "finished": None,
+            "page_name": None,
+            "error": None,
+            "events": [
+                {"time": now, "stage": "queued", "message": f"accepted from {source}"}
+            ],
+        }
+        self.store.save_job(job)
+        return job
+
+    def event(self, job_id: str, stage: str, message: str = "", **fields):
+        job = self.store.get_job(job_id)
+        if job is None:
+            logger.warning(f"Event for unknown job {job_id}: {stage}")
+            return
+        now = time.time()
+        event = {"time": now, "stage": stage, "message": message, **fields}
+        job["events"].append(event)
+        if len(job["events"]) > self.max_events:
+            # Keep the acceptance event and the most recent history
+            job["events"] = job["events"][:1] + job["events"][-(self.max_events - 1) :]
+        job["stage"] = stage
+        if "attempt" in fields:
+            job["attempt"] = fields["attempt"]
+        job["updated"] = now
+        self.store.save_job(job)
+
+    def update(self, job_id: str, message: str = "", **changes):
+        """Change top-level job fields (status, page_name, error...) and log it."""
+        job = self.store.get_job(job_id)
+        if job is None:
+            return
+        now = time.time()
+        job.update(changes)
+        if changes.get("status") in ("succeeded", "failed", "cancelled"):
+            job["finished"] = now
+        job["events"].append(
+            {
+                "time": now,
+                "stage": changes.get("status", job["stage"]),
+                "message": message,
+            }
+        )
+        job["updated"] = now
+        self.store.save_job(job)
+
+    def get(self, job_id: str) -> Optional[dict]:
+        return self.store.get_job(job_id)
+
+    def recent(self, limit: int = 20, since: float = None) -> List[dict]:
+        return [job_summary(job) for job in self.store.list_jobs(limit, since)]
+
+    def has_updates(self, since: Optional[float]) -> bool:
+        latest = self.store.latest_job_update()
+        return latest is not None and (since is None or latest > since)
+
+    async def await_updates(self, since: Optional[float], timeout: float) -> bool:
+        """
+        Wait on the event loop, without a thread, until a job changes after
+        `since` or the timeout passes. The store is re-checked twice a
+        second, which also picks up changes written by other processes.
+        """
+        deadline = time.monotonic() + timeout
+        while not self.has_updates(since):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(remaining, 0.5))
+        return True
+
+    @contextmanager
+    def trace(self, job_id: str):
+        """Make `job_id` the current job for job_event()/job_stage() calls."""
+        token = current_job.set((self, job_id))
+        try:
+            yield
+        finally:
+            current_job.reset(token)
@@ -0,0 +1,296 @@
+import asyncio
+import json
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlparse
+
+import openai
+from a2wsgi import WSGIMiddleware
+
+from model_routing import ModelRouter
+from prefetch import PrefetchPools
+
+logger = logging.getLogger(__name__)
+
+
+def interact_system_message(role: str, expected_type: str) -> str:
+    """Build the system message for /api/llm/interact based on expected type."""
+    return f"""You are {role}.
+You must respond in this exact format:
+{expected_type=='text' and 'A single text string' or
+ expected_type=='list' and 'A JSON array of strings' or
+ expected_type=='json' and 'A JSON object matching the provided schema'}
+"""
+
+
+class LLMProxy:
+    """
+    Serves the LLM proxy endpoints from a dedicated asyncio event loop.
+
+    Pending completions are coroutines on one loop thread, so they cost no
+    OS threads while waiting on OpenAI; a semaphore caps how many upstream
+    calls are in flight at once. With prefetch pools, repeated requests from
+    a page are answered from responses generated in the background.
+    """
+
+    def __init__(
+        self,
+        api_key: str,
+        router: ModelRouter,
+        max_concurrency: int = 64,
+        prefetch: Optional[PrefetchPools] = None,
+    ):
+        self.router = router
+        self.max_concurrency = max_concurrency
+        self.prefetch = prefetch
+        self.client = openai.AsyncOpenAI(api_key=api_key)
+        self.loop = asyncio.new_event_loop()
+        self._semaphore = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run_loop, name="llm-proxy-loop", daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._ready.set()
+        self.loop.run_forever()
+
+    def submit(self, coro) -> Future:
+        """Schedule a coroutine on the proxy loop from any thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """Run a coroutine on the proxy loop and block the calling thread for it."""
+        return self.submit(coro).result()
+
+    async def _complete(self, stage: str, messages, **kwargs) -> Tuple[str, dict]:
+        async with self._semaphore:
+            return await self.router.acomplete(self.client, stage, messages, **kwargs)
+
+    async def _serve(self, endpoint: str, handler, data: dict, source_page):
+        if self.prefetch is None:
+            return await handler(data)
+        return await self.prefetch.serve(endpoint, source_page, data, handler)
+
+    async def interact(
+        self, data: dict, source_page: Optional[str] = None
+    ) -> Tuple[dict, int]:
+        """/api/llm/interact for the page at `source_page` (the Referer path)."""
+        return await self._serve("interact", self._interact, data, source_page)
+
+    async def page(
+        self, data: dict, source_page: Optional[str] = None
+    ) -> Tuple[dict, int]:
+        """/api/llm/page for the page at `source_page` (the Referer path)."""
+        return await self._serve("page", self._page, data, source_page)
+
+    async def prefetch_stats(self) -> Optional[dict]:
+        return self.prefetch.stats() if self.prefetch else None
+
+    async def _interact(self, data: dict) -> Tuple[dict, int]:
+        """Typed (text, list or json) completion for a role."""
+        # Enforce required fields
+        if not data.get("role") or not data.get("prompt"):
+            return {"success": False, "error": "Missing required fields"}, 400
+
+        try:
+            # Parse expected response type
+            expected_type = data.get("expect", "text")  # text, list, or json
+
+            result, route = await self._complete(
+                "interact",
+                [
+                    {
+                        "role": "system",
+                        "content": interact_system_message(data["role"], expected_type),
+                    },
+                    {"role": "user", "content": data["prompt"]},
+                ],
+                temperature=data.get("temperature", 0.7),
+            )
+
+            # Validate and parse response based on expected type
+            if expected_type == "json":
+                try:
+                    result = json.loads(result)
+                except ValueError:
+                    self.router.record_outcome([route], passed=False)
+                    return {"success": False, "error": "Invalid JSON response"}, 500
+            elif expected_type == "list":
+                try:
+                    result = json.loads(result)
+                    if not isinstance(result, list):
+                        raise ValueError("Not a list")
+                except ValueError:
+                    self.router.record_outcome([route], passed=False)
+                    return {"success": False, "error": "Invalid list response"}, 500
+
+            self.router.record_outcome([route], passed=True)
+            return {"success": True, "data": result}, 200
+
+        except Exception as e:
+            logger.error(f"LLM interaction error: {e}")
+            return {"success": False, "error": str(e)}, 500
+
+    async def _page(self, data: dict) -> Tuple[dict, int]:
+        """Plain completion for generated pages."""
+        try:
+            result, route = await self._complete(
+                "page",
+                [
+                    {
+                        "role": "system",
+                        "content": "You are "
+                        + data.get("role", "a helpful AI assistant."),
+                    },
+                    {"role": "user", "content": data.get("prompt", "")},
+                ],
+                temperature=data.get("temperature", 0.7),
+                max_tokens=data.get("max_tokens", 4096),
+                n=1,
+            )
+            self.router.record_outcome([route], passed=True)
+            return {"success": True, "data": result}, 200
+        except Exception as e:
+            logger.error(f"Page LLM interaction error: {e}")
+            return {"success": False, "error": str(e)}, 500
+
+
+async def _read_body(receive, limit: int) -> Optional[bytes]:
+    """The whole request body, or None if it is longer than `limit` bytes."""
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if len(body) > limit:
+            return None
+        if not message.get("more_body"):
+            return body
+
+
+def _replay(body: bytes):
+    """An ASGI receive callable that yields an already-read body."""
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        return {"type": "http.disconnect"}
+
+    return receive
+
+
+async def _send_response(send, status: int, headers, body: bytes):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [
+                (name.lower().encode("latin1"), value.encode("latin1"))
+                for name, value in headers
+            ],
+        }
+    )
+    await send({"type": "http.response.body", "body": body})
+
+
+def create_asgi_app(
+    proxy: LLMProxy,
+    wsgi_app,
+    threads: int = 8,
+    long_polls: dict = None,
+    max_body: int = 1024 * 1024,
+):
+    """
+    ASGI front for the whole site: the LLM proxy routes run as coroutines on
+    the proxy loop, everything else is handed to the Flask WSGI app through
+    a2wsgi on a bounded thread pool, so LLM traffic never occupies those
+    threads. Responses from Flask are streamed, not buffered.
+
+    `long_polls` maps GET paths to coroutines taking the query parameters.
+    For requests with a `wait` parameter the coroutine does the waiting on
+    the event loop, then the request goes to Flask without `wait`.
+
+    Request bodies the front has to read itself (proxy routes, and chunked
+    uploads, which Flask only accepts with a Content-Length) are limited to
+    `max_body` bytes.
+    """
+    routes = {"/api/llm/interact": proxy.interact, "/api/llm/page": proxy.page}
+    long_polls = long_polls or {}
+    wsgi = WSGIMiddleware(wsgi_app, workers=threads)
+    too_large = json.dumps({"success": False, "error": "Request body too large"})
+
+    async def app(scope, receive, send):
+        if scope["type"] != "http":
+            return
+
+        headers = dict(scope.get("headers", []))
+        handler = routes.get(scope["path"]) if scope["method"] == "POST" else None
+
+        if handler is None:
+            waiter = long_polls.get(scope["path"]) if scope["method"] == "GET" else None
+            if waiter is not None:
+                params = dict(
+                    parse_qsl(scope.get("query_string", b"").decode("latin1"))
+                )
+                if "wait" in params:
+                    await waiter(params)
+                    del params["wait"]
+                    scope = dict(scope, query_string=urlencode(params).encode("latin1"))
+
+            if b"transfer-encoding" in headers and b"content-length" not in headers:
+                # Flask reads no body without a length, so buffer it and add one
+                body = await _read_body(receive, max_body)
+                if body is None:
+                    await _send_response(
+                        send,
+                        413,
+                        [("Content-Type", "application/json")],
+                        too_large.encode("utf-8"),
+                    )
+                    return
+                scope = dict(
+                    scope,
+                    headers=[
+                        (name, value)
+                        for name, value in scope["headers"]
+                        if name != b"transfer-encoding"
+                    ]
+                    + [(b"content-length", str(len(body)).encode("latin1"))],
+                )
+                receive = _replay(body)
+
+            await wsgi(scope, receive, send)
+            return
+
+        body = await _read_body(receive, max_body)
+        if body is None:
+            result, status = json.loads(too_large), 413
+        else:
+            try:
+                data = json.loads(body or b"{}")
+                if not isinstance(data, dict):
+                    raise ValueError("Request body must be a JSON object")
+            except ValueError as e:
+                result = {"success": False, "error": f"Invalid request: {e}"}
+                status = 400
+            else:
+                referer = headers.get(b"referer", b"").decode("latin1")
+                result, status = await asyncio.wrap_future(
+                    proxy.submit(handler(data, urlparse(referer).path or None))
+                )
+
+        await _send_response(
+            send,
+            status,
+            [("Content-Type", "application/json")],
+            json.dumps(result).encode("utf-8"),
+        )
+
+    return app
@@ -0,0 +1,193 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import threading
+from typing import Optional
+
+from jobs import current_job_id
+
+TEXT_FORMAT = "%(asctime)s %(levelname)s [%(job_id)s] %(name)s: %(message)s"
+
+
+class JobContextFilter(logging.Filter):
+    """Tag records with the job the logging thread is working on ("-" if none)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.job_id = current_job_id() or "-"
+        return True
+
+
+class DebugSampler(logging.Filter):
+    """
+    Let through at most `per_second` DEBUG records per logger each second;
+    the rest are dropped, and the logger's next record says how many.
+    INFO and above always pass.
+    """
+
+    def __init__(self, per_second: int = 50):
+        super().__init__()
+        self.per_second = per_second
+        self.dropped = 0
+        self._windows = {}  # logger name -> (second, records in it)
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG or not self.per_second:
+            return True
+        second = int(record.created)
+        with self._lock:
+            window, count = self._windows.get(record.name, (second, 0))
+            if window != second:
+                if count > self.per_second:
+                    record.msg = (
+                        f"{record.msg} [{count - self.per_second} more DEBUG "
+                        "records from this logger were sampled out]"
+                    )
+                window, count = second, 0
+            self._windows[record.name] = (window, count + 1)
+            if count < self.per_second:
+                return True
+            self.dropped += 1
+            return False
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to a listener thread through a bounded queue. When the
+    queue is full the record is shed instead of blocking the caller, and a
+    warning with the number of shed records is queued once there is room.
+    Messages longer than `max_chars` (page content, console dumps) are cut.
+    """
+
+    def __init__(self, log_queue: queue.Queue, max_chars: int = 2000):
+        super().__init__(log_queue)
+        self.max_chars = max_chars
+        self.shed = 0
+        self._reported = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Cut the message itself; a traceback is still attached in full
+        message = record.getMessage()
+        if self.max_chars and len(message) > self.max_chars:
+            cut = len(message) - self.max_chars
+            message = f"{message[: self.max_chars]}... [{cut} chars truncated]"
+        record = copy.copy(record)
+        record.msg, record.args = message, None
+        return super().prepare(record)
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.shed += 1
+            return
+        if self.shed > self._reported:
+            shed, self._reported = self.shed - self._reported, self.shed
+            notice = logging.LogRecord(
+                "log_pipeline", logging.WARNING, __file__, 0,
+                f"Log queue full: shed {shed} record(s)", None, None,
+            )  # fmt: skip
+            notice.job_id = "-"
+            try:
+                self.queue.put_nowait(notice)
+            except queue.Full:
+                pass
+
+
+class BoundedQueueListener(logging.handlers.QueueListener):
+    """
+    QueueListener for a bounded queue. The stock stop() puts its sentinel
+    with put_nowait and raises queue.Full when the queue is full; here it
+    waits up to `stop_timeout` seconds for room, and stop() can be called
+    more than once (the CLI's quit and then atexit).
+    """
+
+    stop_timeout = 5.0
+
+    def enqueue_sentinel(self):
+        try:
+            self.queue.put(self._sentinel, timeout=self.stop_timeout)
+        except queue.Full:
+            pass  # the writer is stuck; stop() still returns after its join
+
+    def stop(self):
+        if self._thread is None:
+            return
+        thread = self._thread
+        self.enqueue_sentinel()
+        thread.join(self.stop_timeout)
+        self._thread = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log shippers."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        return json.dumps(
+            {
+                "time": round(record.created, 3),
+                "level": record.levelname,
+                "logger": record.name,
+                "job_id": getattr(record, "job_id", "-"),
+                "thread": record.threadName,
+                "message": record.getMessage(),
+            }
+        )
+
+
+def setup_logging(
+    level: int = logging.DEBUG,
+    queue_size: int = 10000,
+    max_chars: int = 2000,
+    debug_per_second: int = 50,
+    json_format: bool = False,
+    log_file: Optional[str] = None,
+) -> BoundedQueueListener:
+    """
+    Route all logging through a bounded queue to a background writer thread.
+    Replaces any handlers on the root logger; the writer is flushed at exit.
+    """
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = BoundedQueueHandler(log_queue, max_chars=max_chars)
+    handler.addFilter(DebugSampler(debug_per_second))
+    handler.addFilter(JobContextFilter())
+
+    formatter = JsonFormatter() if json_format else logging.Formatter(TEXT_FORMAT)
+    outputs = [logging.StreamHandler(sys.stderr)]
+    if log_file:
+        outputs.append(logging.FileHandler(log_file, encoding="utf-8"))
+    for output in outputs:
+        output.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(handler)
+    root.setLevel(level)
+
+    listener = BoundedQueueListener(log_queue, *outputs)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+def move_console_to_file(listener: logging.handlers.QueueListener, log_file: str):
+    """
+    Stop writing to stderr, e.g. while an interactive prompt owns the
+    terminal, and make sure the records still go to `log_file`.
+    """
+    console = [
+        h
+        for h in listener.handlers
+        if type(h) is logging.StreamHandler and h.stream is sys.stderr
+    ]
+    handlers = [h for h in listener.handlers if h not in console]
+    if console and not any(isinstance(h, logging.FileHandler) for h in handlers):
+        output = logging.FileHandler(log_file, encoding="utf-8")
+        output.setFormatter(console[0].formatter)
+        handlers.append(output)
+    listener.handlers = tuple(handlers)
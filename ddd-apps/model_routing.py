@@ -0,0 +1,189 @@
+import copy
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Stages of the generation pipeline and the proxy endpoints.
+# max_tokens of None means "let the API decide"; timeout is in seconds.
+DEFAULT_ROUTES = {
+    "generate": {"model": "gpt-4", "max_tokens": 4096, "timeout": 180},
+    "repair": {"model": "gpt-4", "max_tokens": 4096, "timeout": 180},
+    "analyze": {"model": "gpt-4", "max_tokens": 200, "timeout": 30},
+    "fix": {"model": "gpt-4", "max_tokens": 4096, "timeout": 180},
+    "page": {"model": "gpt-4", "max_tokens": 4096, "timeout": 60},
+    "interact": {"model": "gpt-4", "max_tokens": None, "timeout": 60},
+}
+
+
+class RouteStats:
+    """Latency and success counters for one (stage, model) route."""
+
+    def __init__(self, window: int = 200):
+        self.calls = 0
+        self.errors = 0
+        self.passed = 0
+        self.failed = 0
+        self.total_seconds = 0.0
+        self.recent = deque(maxlen=window)
+
+    def snapshot(self) -> dict:
+        latencies = sorted(self.recent)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+
+        outcomes = self.passed + self.failed
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_seconds": (
+                round(self.total_seconds / self.calls, 3) if self.calls else None
+            ),
+            "p50_seconds": percentile(0.5),
+            "p95_seconds": percentile(0.95),
+            "pass_rate": round(self.passed / outcomes, 3) if outcomes else None,
+            "passed": self.passed,
+            "failed": self.failed,
+        }
+
+
+class ModelRouter:
+    """
+    Picks model, max_tokens and timeout per pipeline stage.
+
+    A route may carry escalation rules that switch to a stronger model on
+    retries, e.g.::
+
+        "analyze": {
+            "model": "gpt-4o-mini", "max_tokens": 200, "timeout": 20,
+            "escalate": [{"min_attempt": 2, "model": "gpt-4"}]
+        }
+
+    ``min_attempt`` is zero-based, matching create_page's attempt counter.
+    """
+
+    def __init__(self, routes: Optional[dict] = None):
+        self.routes = copy.deepcopy(DEFAULT_ROUTES)
+        for stage, route in (routes or {}).items():
+            self.routes.setdefault(stage, {}).update(route)
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    @classmethod
+    def from_file(cls, path: Optional[str]) -> "ModelRouter":
+        """Load overrides from a JSON file; a missing path means defaults."""
+        if not path or not os.path.exists(path):
+            return cls()
+        with open(path, "r", encoding="utf-8") as f:
+            routes = json.load(f)
+        logger.info(f"Loaded model routes from {path}")
+        return cls(routes)
+
+    def route(self, stage: str, attempt: int = 0) -> dict:
+        """Resolve the route for a stage, applying the strongest matching escalation."""
+        base = self.routes[stage]
+        resolved = {
+            "stage": stage,
+            "model": base["model"],
+            "max_tokens": base.get("max_tokens"),
+            "timeout": base.get("timeout"),
+        }
+        rules = [r for r in base.get("escalate", []) if attempt >= r["min_attempt"]]
+        if rules:
+            rule = max(rules, key=lambda r: r["min_attempt"])
+            for key in ("model", "max_tokens", "timeout"):
+                if key in rule:
+                    resolved[key] = rule[key]
+        return resolved
+
+    def request_kwargs(self, route: dict, kwargs: dict) -> dict:
+        """Merge a route into chat.completions.create keyword arguments."""
+        kwargs = dict(kwargs, model=route["model"])
+        if route["max_tokens"] is not None:
+            requested = kwargs.get("max_tokens")
+            kwargs["max_tokens"] = (
+                min(requested, route["max_tokens"])
+                if requested is not None
+                else route["max_tokens"]
+            )
+        if route["timeout"] is not None:
+            # A caller's timeout (e.g. a job's remaining time) can only shorten the route's
+            requested = kwargs.get("timeout")
+            kwargs["timeout"] = (
+                min(requested, route["timeout"])
+                if requested is not None
+                else route["timeout"]
+            )
+        return kwargs
+
+    def _stats_for(self, route: dict) -> RouteStats:
+        key = (route["stage"], route["model"])
+        if key not in self._stats:
+            self._stats[key] = RouteStats()
+        return self._stats[key]
+
+    def record_call(self, route: dict, seconds: float, error: bool = False):
+        with self._lock:
+            stats = self._stats_for(route)
+            stats.calls += 1
+            stats.total_seconds += seconds
+            stats.recent.append(seconds)
+            if error:
+                stats.errors += 1
+
+    def record_outcome(self, routes: List[dict], passed: bool):
+        """Credit every route used in a pipeline attempt with its final result."""
+        with self._lock:
+            for route in routes:
+                stats = self._stats_for(route)
+                if passed:
+                    stats.passed += 1
+                else:
+                    stats.failed += 1
+
+    def complete(
+        self, client, stage: str, messages, attempt: int = 0, **kwargs
+    ) -> Tuple[str, dict]:
+        """Run a routed chat completion; returns (stripped content, route used)."""
+        route = self.route(stage, attempt)
+        started = time.monotonic()
+        try:
+            response = client.chat.completions.create(
+                messages=messages, **self.request_kwargs(route, kwargs)
+            )
+        except Exception:
+            self.record_call(route, time.monotonic() - started, error=True)
+            raise
+        self.record_call(route, time.monotonic() - started)
+        return response.choices[0].message.content.strip(), route
+
+    async def acomplete(
+        self, client, stage: str, messages, attempt: int = 0, **kwargs
+    ) -> Tuple[str, dict]:
+        """Async variant of complete() for the AsyncOpenAI client."""
+        route = self.route(stage, attempt)
+        started = time.monotonic()
+        try:
+            response = await client.chat.completions.create(
+                messages=messages, **self.request_kwargs(route, kwargs)
+            )
+        except Exception:
+            self.record_call(route, time.monotonic() - started, error=True)
+            raise
+        self.record_call(route, time.monotonic() - started)
+        return response.choices[0].message.content.strip(), route
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                f"{stage}:{model}": stats.snapshot()
+                for (stage, model), stats in sorted(self._stats.items())
+            }
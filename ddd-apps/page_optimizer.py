@@ -0,0 +1,569 @@
+import logging
+import re
+import threading
+import urllib.request
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urljoin
+
+logger = logging.getLogger(__name__)
+
+# Raw-text elements whose contents must not be treated as markup
+RAW_BLOCK_RE = re.compile(
+    r"(<(script|style|pre|textarea)\b(?:\"[^\"]*\"|'[^']*'|[^'\">])*>)(.*?)(</\2\s*>)",
+    re.IGNORECASE | re.DOTALL,
+)
+TAG_RE = re.compile(r"<!--.*?-->|<(?:\"[^\"]*\"|'[^']*'|[^'\">])*>", re.DOTALL)
+LINK_RE = re.compile(r"<link\b(?:\"[^\"]*\"|'[^']*'|[^'\">])*>", re.IGNORECASE)
+ATTR_RE = re.compile(r"([\w:-]+)\s*=\s*(\"[^\"]*\"|'[^']*'|[^\s>]+)")
+CSS_URL_RE = re.compile(r"url\(\s*(['\"]?)([^'\")]+)\1\s*\)")
+JS_TYPES = ("", "text/javascript", "application/javascript", "module")
+
+# Every script use of className / classList and what follows it
+CLASS_TOKEN_RE = re.compile(
+    r"\b(className|classList)\b\s*"
+    r"(\+?=(?!=)|:|\.\s*(\w+)\s*(?:\(|\+?=(?!=))|[,}]|\.|)"
+)
+# Ids (and class names by attribute) set from scripts
+ID_ASSIGN_RE = re.compile(
+    r"(?:\.id|\[\s*['\"](?:className|id)['\"]\s*\])\s*\+?=(?!=)\s*([^;\n}]*)"
+)
+ATTR_CALL_RE = re.compile(
+    r"(?:setAttribute|attr)\(\s*['\"](?:class|id)['\"]\s*,([^)]*)\)"
+    r"|(?:addClass|toggleClass)\s*\(([^)]*)\)"
+)
+# class= / id= in markup; anything but a plain quoted or bare word value is
+# built at runtime (class="tile' + v, class="${c}", class=${c})
+MARKUP_ATTR_RE = re.compile(r"\b(?:class\s*=\s*|id=(?=\\?[\"'`$]))")
+PLAIN_ATTR_VALUE_RE = re.compile(
+    r"""(\\?)(["'])[^"'`<>${}+\\]*\1\2(?!\s*\+)|[\w-]+(?![\w$'"`{+-])"""
+)
+STRING_LITERAL_RE = re.compile(r"""\s*(?:'[^'\\\n]*'|"[^"\\\n]*"|`[^`$\\]*`)\s*""")
+
+# Words after which a "/" starts a regular expression rather than a division
+REGEX_KEYWORDS = {
+    "return", "typeof", "instanceof", "case", "do", "else", "in", "of",
+    "new", "delete", "void", "throw", "yield", "await",
+}  # fmt: skip
+
+# Jinja renders generated pages, so the optimizer must never create delimiters
+JINJA_DELIMITERS = ("{{", "{%", "{#")
+
+_stylesheet_cache: Dict[str, Optional[str]] = {}
+_stylesheet_cache_lock = threading.Lock()
+
+
+def _skip_string(text: str, i: int) -> int:
+    """Index just past the quoted string starting at text[i]."""
+    quote = text[i]
+    i += 1
+    while i < len(text) and text[i] != quote:
+        if text[i] == "\\":
+            i += 1
+        elif text[i] == "\n" and quote != "`":
+            break
+        i += 1
+    return i + 1
+
+
+def minify_css(css: str) -> str:
+    """Strip comments and whitespace that CSS does not need; strings are kept intact."""
+    out = []
+    i, n = 0, len(css)
+    while i < n:
+        c = css[i]
+        if c in "\"'":
+            j = _skip_string(css, i)
+            out.append(css[i:j])
+            i = j
+        elif css.startswith("/*", i):
+            end = css.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+        elif c.isspace():
+            while i < n and css[i].isspace():
+                i += 1
+            last = out[-1][-1] if out else ""
+            nxt = css[i] if i < n else ""
+            # No space is needed next to these; "(" is kept before so
+            # "and (" in media queries never turns into a function token.
+            # "{#", "{%" and "{{" would open a Jinja tag, so keep that space.
+            if last == "{" and nxt in "#%{":
+                out.append(" ")
+            elif last not in "{};,>:( " and nxt not in "{};,>)" and nxt:
+                out.append(" ")
+        elif c == "}" and out and out[-1] == ";":
+            out[-1] = "}"
+            i += 1
+        else:
+            out.append(c)
+            i += 1
+    return "".join(out).strip()
+
+
+def minify_js(js: str) -> str:
+    """
+    Conservative JS minifier: drops comments, indentation, blank lines and
+    spaces next to unambiguous punctuation. Newlines are kept so automatic
+    semicolon insertion behaves exactly as before.
+    """
+    out = []
+    i, n = 0, len(js)
+    # Brace depth per open template literal substitution
+    template_stack: List[int] = []
+    last_word = ""
+
+    def last_char():
+        return out[-1][-1] if out else ""
+
+    def last_significant():
+        for chunk in reversed(out):
+            stripped = chunk.rstrip()
+            if stripped:
+                return stripped[-1]
+        return ""
+
+    while i < n:
+        c = js[i]
+        if c in "\"'":
+            j = _skip_string(js, i)
+            out.append(js[i:j])
+            i = j
+            last_word = ""
+        elif c == "`":
+            i = _copy_template(js, i, out, template_stack)
+            last_word = ""
+        elif c == "}" and template_stack and template_stack[-1] == 0:
+            # End of a ${...} substitution: back into the template literal
+            template_stack.pop()
+            out.append("}")
+            i = _copy_template(js, i + 1, out, template_stack, opened=False)
+        elif js.startswith("//", i):
+            end = js.find("\n", i)
+            i = n if end == -1 else end
+        elif js.startswith("/*", i):
+            end = js.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+            if last_char() not in " \n":
+                out.append(" ")
+        elif c == "/" and (
+            last_significant() in "(,=:[!&|?{};+-*%<>~^" or last_word in REGEX_KEYWORDS
+        ):
+            j = _skip_regex(js, i)
+            out.append(js[i:j])
+            i = j
+            last_word = ""
+        elif c.isspace():
+            newline = False
+            while i < n and js[i].isspace():
+                newline = newline or js[i] == "\n"
+                i += 1
+            last = last_char()
+            nxt = js[i] if i < n else ""
+            if not last or not nxt:
+                continue
+            if newline:
+                if last != "\n":
+                    out.append("\n")
+            elif last == "{" and nxt in "#%{":
+                out.append(" ")  # never open a Jinja tag
+            elif last not in "{}()[];,:= \n" and nxt not in "{}()[];,:=":
+                out.append(" ")
+        else:
+            if c in "{" and template_stack:
+                template_stack[-1] += 1
+            elif c == "}" and template_stack:
+                template_stack[-1] -= 1
+            if c.isalnum() or c in "_$":
+                j = i
+                while j < n and (js[j].isalnum() or js[j] in "_$"):
+                    j += 1
+                last_word = js[i:j]
+                out.append(last_word)
+                i = j
+                continue
+            last_word = ""
+            out.append(c)
+            i += 1
+    return "".join(out).strip()
+
+
+def _copy_template(js: str, i: int, out: list, stack: list, opened: bool = True) -> int:
+    """Copy a template literal verbatim up to its end or the next ${."""
+    start = i
+    if opened:
+        i += 1
+    while i < len(js):
+        if js[i] == "\\":
+            i += 2
+            continue
+        if js[i] == "`":
+            out.append(js[start : i + 1])
+            return i + 1
+        if js.startswith("${", i):
+            out.append(js[start : i + 2])
+            stack.append(0)
+            return i + 2
+        i += 1
+    out.append(js[start:])
+    return len(js)
+
+
+def _skip_regex(js: str, i: int) -> int:
+    """Index just past the regex literal (and flags) starting at js[i]."""
+    in_class = False
+    i += 1
+    while i < len(js) and js[i] != "\n":
+        c = js[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "[":
+            in_class = True
+        elif c == "]":
+            in_class = False
+        elif c == "/" and not in_class:
+            i += 1
+            while i < len(js) and js[i].isalpha():
+                i += 1
+            return i
+        i += 1
+    return i
+
+
+def _split_top_level(text: str, sep: str) -> List[str]:
+    parts, depth, start, i = [], 0, 0, 0
+    while i < len(text):
+        c = text[i]
+        if c in "\"'":
+            i = _skip_string(text, i)
+            continue
+        if c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return parts
+
+
+def _css_blocks(css: str) -> List[Tuple[str, str]]:
+    """Split (comment-free) CSS into top-level (prelude, body) pairs; body None for statements."""
+    blocks = []
+    i, n, start = 0, len(css), 0
+    while i < n:
+        c = css[i]
+        if c in "\"'":
+            i = _skip_string(css, i)
+            continue
+        if c == ";":
+            blocks.append((css[start : i + 1], None))
+            start = i + 1
+        elif c == "{":
+            depth, j = 1, i + 1
+            while j < n and depth:
+                if css[j] in "\"'":
+                    j = _skip_string(css, j)
+                    continue
+                depth += {"{": 1, "}": -1}.get(css[j], 0)
+                j += 1
+            blocks.append((css[start:i], css[i + 1 : j - 1]))
+            i = start = j
+            continue
+        i += 1
+    if css[start:].strip():
+        blocks.append((css[start:], None))
+    return blocks
+
+
+def _literal(value: str) -> bool:
+    return STRING_LITERAL_RE.fullmatch(value) is not None
+
+
+def _builds_names(document: str) -> bool:
+    """
+    Whether a script computes class names or ids at runtime, so no CSS rule
+    can be proven unused. Any className, classList or class= whose value is
+    not a plain literal counts, e.g.:
+
+    >>> _builds_names("el.className = 'tile-' + n")
+    True
+    >>> _builds_names("Object.assign(el, {className: 'tile-' + n})")
+    True
+    >>> _builds_names("el.classList = 'tile-' + v")
+    True
+    >>> _builds_names("html += `<div class=${cls}>`")
+    True
+    >>> _builds_names("html += '<div class=\\"tile' + v + '\\">'")
+    True
+    >>> _builds_names("el.classList.add(names[i] + 'Team')")
+    True
+    >>> _builds_names("el.classList.toggle('open', isOpen); el.id = 'main'")
+    False
+    >>> _builds_names("if (el.className.split(' ').includes('x')) go()")
+    False
+    >>> _builds_names('<div class="card big" id="b"></div>')
+    False
+    """
+    for match in CLASS_TOKEN_RE.finditer(document):
+        op, method = match.group(2), match.group(3)
+        rest = document[match.end() :]
+        if op in (",", "}"):
+            return True  # shorthand property: {className}
+        if op in (".", ""):
+            # className read, or classList read (.length); a bare classList
+            # is being handed to other code
+            if match.group(1) == "classList" and op == "":
+                return True
+            continue
+        if (
+            method is not None
+            and not op.endswith("=")
+            and match.group(1) == "className"
+        ):
+            continue  # a string method on the current className
+        if method is None or op.endswith("="):
+            # Assignment (=, +=, .value =) or object property (:)
+            value = re.match(r"[^,;\n}]*" if op == ":" else r"[^;\n}]*", rest)
+            if not _literal(value.group(0)):
+                return True
+        elif method in ("add", "toggle", "replace"):
+            args = _split_top_level(re.match(r"[^)]*", rest).group(0), ",")
+            if method == "toggle":
+                args = args[:1]  # the second argument is the on/off flag
+            if not all(_literal(arg) for arg in args):
+                return True
+        elif method not in ("remove", "contains", "item"):
+            return True
+    for match in ID_ASSIGN_RE.finditer(document):
+        if not _literal(match.group(1)):
+            return True
+    for match in ATTR_CALL_RE.finditer(document):
+        value = match.group(1) if match.group(1) is not None else match.group(2)
+        if not all(_literal(arg) for arg in _split_top_level(value, ",")):
+            return True
+    return any(
+        PLAIN_ATTR_VALUE_RE.match(document, match.end()) is None
+        for match in MARKUP_ATTR_RE.finditer(document)
+    )
+
+
+class _ReferenceIndex:
+    """Answers whether a class or id name is referenced by the page's markup or scripts."""
+
+    def __init__(self, document: str):
+        self.document = document
+        self.dynamic = _builds_names(document)
+        self._cache = {}
+
+    def __contains__(self, name: str) -> bool:
+        if name not in self._cache:
+            self._cache[name] = (
+                re.search(rf"(?<![\w-]){re.escape(name)}(?![\w-])", self.document)
+                is not None
+            )
+        return self._cache[name]
+
+
+def _selector_used(selector: str, refs: _ReferenceIndex) -> bool:
+    # :not(.x) and attribute values do not require .x to exist
+    selector = re.sub(r":not\([^)]*\)|\[[^\]]*\]", "", selector)
+    names = re.findall(r"[.#](-?[_a-zA-Z][\w-]*)", selector)
+    return all(name in refs for name in names)
+
+
+def strip_unused_css(css: str, refs: _ReferenceIndex) -> Tuple[str, int]:
+    """
+    Drop style rules whose every selector names a class or id the page never
+    uses. Nothing is dropped if the page's scripts build names at runtime.
+    """
+    if refs.dynamic:
+        return css, 0
+    kept, removed = [], 0
+    for prelude, body in _css_blocks(css):
+        head = prelude.strip()
+        if body is None:
+            kept.append(prelude)
+        elif head.startswith("@"):
+            if head.lower().startswith(("@media", "@supports")):
+                body, inner_removed = strip_unused_css(body, refs)
+                removed += inner_removed
+                if body.strip():
+                    kept.append(f"{prelude}{{{body}}}")
+                else:
+                    removed += 1
+            else:
+                kept.append(f"{prelude}{{{body}}}")
+        elif any(_selector_used(s, refs) for s in _split_top_level(head, ",")):
+            kept.append(f"{prelude}{{{body}}}")
+        else:
+            removed += 1
+    return "".join(kept), removed
+
+
+def _minify_markup(html: str) -> str:
+    """Drop comments and collapse whitespace between tags; tags are kept verbatim."""
+    out, last = [], 0
+    for match in TAG_RE.finditer(html):
+        out.append(re.sub(r"\s+", " ", html[last : match.start()]))
+        tag = match.group(0)
+        if not tag.startswith("<!--") or tag.startswith("<!--["):
+            out.append(tag)
+        last = match.end()
+    out.append(re.sub(r"\s+", " ", html[last:]))
+    return "".join(out)
+
+
+class PageOptimizer:
+    """
+    Save-time optimization for generated pages: minifies HTML, CSS and JS,
+    strips CSS rules the page never uses, inlines small CDN stylesheets
+    (deferring the rest so they do not block first paint) and enforces a
+    byte budget.
+    """
+
+    def __init__(
+        self,
+        byte_budget: int = 60000,
+        inline_max_bytes: int = 16384,
+        fetch_timeout: float = 3.0,
+        enabled: bool = True,
+    ):
+        self.byte_budget = byte_budget
+        self.inline_max_bytes = inline_max_bytes
+        self.fetch_timeout = fetch_timeout
+        self.enabled = enabled
+
+    def optimize(self, html: str) -> Tuple[str, dict]:
+        """
+        Returns (optimized page, report). The report has the before/after
+        sizes and, if the page is over budget, an "error" for the repair loop.
+        """
+        original_bytes = len(html.encode("utf-8"))
+        report = {
+            "original_bytes": original_bytes,
+            "optimized_bytes": original_bytes,
+            "css_rules_removed": 0,
+            "stylesheets_inlined": 0,
+            "stylesheets_deferred": 0,
+            "error": None,
+        }
+        optimized = html
+        if self.enabled:
+            try:
+                optimized = self._optimize(html, report)
+            except Exception as e:
+                logger.warning(f"Page optimization failed, keeping original: {e}")
+                optimized = html
+            if any(optimized.count(d) > html.count(d) for d in JINJA_DELIMITERS):
+                logger.warning(
+                    "Optimization created template delimiters, keeping original"
+                )
+                optimized = html
+
+        size = len(optimized.encode("utf-8"))
+        report["optimized_bytes"] = size
+        if self.byte_budget and size > self.byte_budget:
+            report["error"] = (
+                f"Page is {size} bytes after minification, over the "
+                f"{self.byte_budget}-byte budget. Remove duplicated CSS and repeated "
+                "markup, build repetitive elements in JS loops, and generate bulky "
+                "text content through the LLM helper instead of hard-coding it."
+            )
+        return optimized, report
+
+    def _optimize(self, html: str, report: dict) -> str:
+        html = self._handle_stylesheets(html, report)
+        # Markup and scripts, without styles, decide which CSS rules are used
+        refs = _ReferenceIndex(
+            re.sub(r"<style\b.*?</style\s*>", "", html, flags=re.I | re.S)
+        )
+        if refs.dynamic:
+            logger.debug("Scripts build class names or ids, keeping all CSS rules")
+
+        out, last = [], 0
+        for match in RAW_BLOCK_RE.finditer(html):
+            out.append(_minify_markup(html[last : match.start()]))
+            open_tag, name, body, close_tag = match.groups()
+            name = name.lower()
+            if name == "style":
+                body, removed = strip_unused_css(minify_css(body), refs)
+                report["css_rules_removed"] += removed
+            elif name == "script" and "src=" not in open_tag.lower():
+                script_type = re.search(r"type\s*=\s*[\"']?([\w/]+)", open_tag, re.I)
+                if (script_type.group(1).lower() if script_type else "") in JS_TYPES:
+                    body = minify_js(body)
+            out.append(open_tag + body + close_tag)
+            last = match.end()
+        out.append(_minify_markup(html[last:]))
+        return "".join(out).strip()
+
+    def _handle_stylesheets(self, html: str, report: dict) -> str:
+        """Inline small external stylesheets; load the others without blocking render."""
+        refs = None
+
+        def replace(match):
+            nonlocal refs
+            tag = match.group(0)
+            attrs = {k.lower(): v.strip("\"'") for k, v in ATTR_RE.findall(tag)}
+            href = attrs.get("href", "")
+            if "stylesheet" not in attrs.get("rel", "").lower() or not href.startswith(
+                ("http://", "https://", "//")
+            ):
+                return tag
+            url = "https:" + href if href.startswith("//") else href
+
+            css = self._fetch_stylesheet(url) if self.inline_max_bytes else None
+            if css is not None:
+                if refs is None:
+                    refs = _ReferenceIndex(html)
+                css = CSS_URL_RE.sub(
+                    lambda m: f"url({m.group(1)}{urljoin(url, m.group(2))}{m.group(1)})",
+                    css,
+                )
+                css, removed = strip_unused_css(minify_css(css), refs)
+                if len(css.encode("utf-8")) <= self.inline_max_bytes:
+                    report["stylesheets_inlined"] += 1
+                    report["css_rules_removed"] += removed
+                    return f"<style>{css}</style>"
+
+            report["stylesheets_deferred"] += 1
+            extra = "".join(
+                f' {k}="{attrs[k]}"'
+                for k in ("integrity", "crossorigin", "referrerpolicy")
+                if k in attrs
+            )
+            return (
+                f'<link rel="preload" as="style" href="{href}"{extra} '
+                "onload=\"this.onload=null;this.rel='stylesheet'\">"
+                f'<noscript><link rel="stylesheet" href="{href}"{extra}></noscript>'
+            )
+
+        return LINK_RE.sub(replace, html)
+
+    def _fetch_stylesheet(self, url: str) -> Optional[str]:
+        """Download a stylesheet once per process; None if unavailable or too large."""
+        with _stylesheet_cache_lock:
+            if url in _stylesheet_cache:
+                return _stylesheet_cache[url]
+        css = None
+        try:
+            request = urllib.request.Request(
+                url,
+                # Font services pick the font format from the user agent
+                headers={"User-Agent": "Mozilla/5.0 Chrome/120.0 Safari/537.36"},
+            )
+            with urllib.request.urlopen(
+                request, timeout=self.fetch_timeout
+            ) as response:
+                # Stylesheets are only inlined after unused rules are stripped,
+                # so allow large sources such as icon fonts to be fetched
+                body = response.read(1024 * 1024 + 1)
+                if len(body) <= 1024 * 1024:
+                    css = body.decode("utf-8", errors="replace")
+        except Exception as e:
+            logger.debug(f"Could not fetch stylesheet {url}: {e}")
+        with _stylesheet_cache_lock:
+            _stylesheet_cache[url] = css
+        return css
@@ -0,0 +1,180 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict, deque
+from typing import Awaitable, Callable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# A proxy handler: request body -> (response body, HTTP status)
+Handler = Callable[[dict], Awaitable[Tuple[dict, int]]]
+
+# Request fields that change the completion, and so tell pools apart
+KEY_FIELDS = ("role", "prompt", "expect", "temperature", "max_tokens")
+
+
+def _fingerprint(result: dict) -> str:
+    return json.dumps(result.get("data"), sort_keys=True)
+
+
+class _Pool:
+    """Ready responses for one (page, role, prompt) request."""
+
+    def __init__(self, data: dict, handler: Handler):
+        self.data = dict(data)
+        self.handler = handler
+        self.ready = deque()  # (created, response body)
+        # Responses already buffered or served, so refills only add new ones
+        self.seen = deque(maxlen=50)
+        self.requests = 0
+        self.last_used = time.monotonic()
+        self.refill = None
+
+    def pop_fresh(self, max_age: float) -> Optional[dict]:
+        now = time.monotonic()
+        while self.ready:
+            created, result = self.ready.popleft()
+            if now - created <= max_age:
+                return result
+        return None
+
+
+class PrefetchPools:
+    """
+    Keeps a few ready, distinct responses for LLM requests that generated
+    pages repeat on every load (a story, a poem, quiz questions).
+
+    A request with a buffered response is answered at once and the pool is
+    topped up in the background, up to `depth` responses and within a
+    rolling token budget. A request must be seen `min_requests` times before
+    its pool is filled, so one-off prompts built from user input cost
+    nothing extra. Pools without traffic for `idle_seconds` are dropped.
+
+    All methods run on the LLM proxy event loop, so no locking is needed.
+    """
+
+    def __init__(
+        self,
+        depth: int = 3,
+        token_budget: int = 200000,
+        budget_window: float = 3600,
+        idle_seconds: float = 900,
+        max_age: float = 3600,
+        min_requests: int = 2,
+        max_pools: int = 200,
+    ):
+        self.depth = depth
+        self.token_budget = token_budget
+        self.budget_window = budget_window
+        self.idle_seconds = idle_seconds
+        self.max_age = max_age
+        self.min_requests = min_requests
+        self.max_pools = max_pools
+        self.pools = OrderedDict()
+        self.spent = deque()  # (time, estimated tokens) of background calls
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def pool_key(endpoint: str, page: Optional[str], data: dict) -> str:
+        fields = {k: data.get(k) for k in KEY_FIELDS}
+        return json.dumps([endpoint, page or "", fields], sort_keys=True)
+
+    async def serve(
+        self, endpoint: str, page: Optional[str], data: dict, handler: Handler
+    ) -> Tuple[dict, int]:
+        """Answer from the pool if it has a response, otherwise call the handler."""
+        if not self.depth:
+            return await handler(data)
+
+        self._evict()
+        key = self.pool_key(endpoint, page, data)
+        pool = self.pools.get(key)
+        result = pool.pop_fresh(self.max_age) if pool else None
+        if result is not None:
+            self.hits += 1
+            status = 200
+        else:
+            self.misses += 1
+            result, status = await handler(data)
+            if status != 200:
+                return result, status
+            if pool is None:
+                pool = self._add_pool(key, data, handler)
+            pool.seen.append(_fingerprint(result))
+
+        self.pools.move_to_end(key)
+        pool.requests += 1
+        pool.last_used = time.monotonic()
+        if pool.requests >= self.min_requests and pool.refill is None:
+            pool.refill = asyncio.ensure_future(self._refill(key, pool))
+        return result, status
+
+    def _add_pool(self, key: str, data: dict, handler: Handler) -> _Pool:
+        pool = self.pools[key] = _Pool(data, handler)
+        while len(self.pools) > self.max_pools:
+            _, evicted = self.pools.popitem(last=False)
+            self._drop(evicted)
+        return pool
+
+    def _drop(self, pool: _Pool):
+        if pool.refill is not None:
+            pool.refill.cancel()
+
+    def _evict(self):
+        """Drop pools nobody has requested for idle_seconds."""
+        cutoff = time.monotonic() - self.idle_seconds
+        for key in [k for k, p in self.pools.items() if p.last_used < cutoff]:
+            self._drop(self.pools.pop(key))
+            logger.debug(f"Evicted idle prefetch pool {key}")
+
+    def _tokens_spent(self) -> int:
+        cutoff = time.monotonic() - self.budget_window
+        while self.spent and self.spent[0][0] < cutoff:
+            self.spent.popleft()
+        return sum(tokens for _, tokens in self.spent)
+
+    async def _refill(self, key: str, pool: _Pool):
+        duplicates = 0
+        try:
+            while len(pool.ready) < self.depth and self.pools.get(key) is pool:
+                if self._tokens_spent() >= self.token_budget:
+                    logger.debug("Prefetch token budget used up, not refilling")
+                    break
+                result, status = await pool.handler(dict(pool.data))
+                # Rough count (4 characters per token) of prompt and response
+                text = f"{pool.data.get('role', '')}{pool.data.get('prompt', '')}"
+                self.spent.append(
+                    (time.monotonic(), (len(text) + len(json.dumps(result))) // 4)
+                )
+                if status != 200:
+                    break
+                fingerprint = _fingerprint(result)
+                if fingerprint in pool.seen:
+                    # The prompt keeps producing the same answer; stop paying for it
+                    duplicates += 1
+                    if duplicates >= 3:
+                        break
+                    continue
+                pool.seen.append(fingerprint)
+                pool.ready.append((time.monotonic(), result))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Prefetch refill failed: {e}")
+        finally:
+            pool.refill = None
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "pools": len(self.pools),
+            "buffered": sum(len(p.ready) for p in self.pools.values()),
+            "refilling": sum(1 for p in self.pools.values() if p.refill is not None),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / requests, 3) if requests else None,
+            "tokens_in_window": self._tokens_spent(),
+            "token_budget": self.token_budget,
+        }
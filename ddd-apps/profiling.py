@@ -0,0 +1,275 @@
+import contextvars
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# Session of the request or job the current thread or task belongs to
+current_session = contextvars.ContextVar("current_profile_session", default=None)
+
+
+def _thread_cpu_clock(ident: int) -> Optional[int]:
+    """Clock id for a thread's CPU time, where the platform provides one."""
+    try:
+        return time.pthread_getcpuclockid(ident)
+    except (AttributeError, OSError):
+        return None
+
+
+def _collapse(frame) -> str:
+    """Render a frame's stack, outermost first, as one collapsed-stack line."""
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+class ProfileSession:
+    """
+    Stacks sampled from the threads working on one request or job.
+
+    Both profiles are weighted in microseconds: wall time is credited to the
+    stack a thread was in at each sample, CPU time to the stack that was
+    running while the thread's CPU clock advanced.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.started = time.time()
+        self.wall = Counter()
+        self.cpu = Counter()
+        self.samples = 0
+        # thread ident -> (CPU clock id, last CPU reading in ns, attach count)
+        self.threads = {}
+        self._lock = threading.Lock()
+
+    def attach(self, ident: int):
+        with self._lock:
+            clock, reading, count = self.threads.get(ident, (None, None, 0))
+            if count == 0:
+                clock = _thread_cpu_clock(ident)
+                reading = time.clock_gettime_ns(clock) if clock is not None else None
+            self.threads[ident] = (clock, reading, count + 1)
+
+    def detach(self, ident: int):
+        with self._lock:
+            clock, reading, count = self.threads[ident]
+            if count <= 1:
+                del self.threads[ident]
+            else:
+                self.threads[ident] = (clock, reading, count - 1)
+
+    def sample(self, frames: dict, elapsed_us: int):
+        with self._lock:
+            self.samples += 1
+            for ident, (clock, reading, count) in list(self.threads.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = _collapse(frame)
+                self.wall[stack] += elapsed_us
+                if clock is not None:
+                    try:
+                        now = time.clock_gettime_ns(clock)
+                    except OSError:
+                        continue
+                    if now > reading:
+                        self.cpu[stack] += (now - reading) // 1000
+                    self.threads[ident] = (clock, now, count)
+
+
+class Profiler:
+    """
+    On-demand sampling profiler for selected Flask routes and generation jobs.
+
+    Which requests and jobs are profiled is changed at runtime with
+    set_route(), set_jobs() and add_job(); each takes a sampling rate, the
+    fraction of requests or jobs to profile. While no session is running the
+    sampler thread is stopped and the only cost is a dictionary lookup per
+    request. Each finished session writes .wall.folded and .cpu.folded files
+    in collapsed-stack format (flamegraph.pl, speedscope, inferno).
+    """
+
+    def __init__(self, output_dir: str = "profiles", interval: float = 0.005):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.routes: Dict[str, float] = {}
+        self.jobs_rate = 0.0
+        self.job_ids = set()
+        self.recent = deque(maxlen=50)
+        self._sessions: List[ProfileSession] = []
+        self._lock = threading.Lock()
+        self._sampler = None
+
+    # Runtime configuration
+
+    def set_route(self, endpoint: str, rate: float = 1.0):
+        """Profile `rate` of requests to a Flask endpoint; 0 stops profiling it."""
+        if rate > 0:
+            self.routes[endpoint] = min(rate, 1.0)
+        else:
+            self.routes.pop(endpoint, None)
+
+    def set_jobs(self, rate: float):
+        """Profile `rate` of generation jobs; 0 stops."""
+        self.jobs_rate = max(0.0, min(rate, 1.0))
+
+    def add_job(self, job_id: str):
+        """Profile a specific job when it starts running."""
+        self.job_ids.add(job_id)
+
+    def reset(self):
+        self.routes.clear()
+        self.jobs_rate = 0.0
+        self.job_ids.clear()
+
+    def status(self) -> dict:
+        with self._lock:
+            active = [s.name for s in self._sessions]
+        return {
+            "routes": dict(self.routes),
+            "jobs_rate": self.jobs_rate,
+            "job_ids": sorted(self.job_ids),
+            "interval_ms": round(self.interval * 1000, 3),
+            "output_dir": os.path.abspath(self.output_dir),
+            "active": active,
+            "recent": list(self.recent),
+        }
+
+    # Sessions
+
+    def wants_route(self, endpoint: Optional[str]) -> bool:
+        rate = self.routes.get(endpoint) if self.routes else None
+        return bool(rate) and random.random() < rate
+
+    def wants_job(self, job_id: str) -> bool:
+        if job_id in self.job_ids:
+            self.job_ids.discard(job_id)
+            return True
+        return self.jobs_rate > 0 and random.random() < self.jobs_rate
+
+    def start(self, name: str) -> ProfileSession:
+        """Start a session sampling the calling thread."""
+        session = ProfileSession(name)
+        session.attach(threading.get_ident())
+        with self._lock:
+            self._sessions.append(session)
+            if self._sampler is None:
+                self._sampler = threading.Thread(
+                    target=self._sample_loop, name="profiler", daemon=True
+                )
+                self._sampler.start()
+        return session
+
+    def stop(self, session: ProfileSession) -> Optional[str]:
+        """Stop a session and write its profiles; returns the wall profile path."""
+        with self._lock:
+            if session not in self._sessions:
+                return None
+            self._sessions.remove(session)
+        try:
+            return self._write(session)
+        except OSError as e:
+            logger.error(f"Could not write profile {session.name}: {e}")
+            return None
+
+    @contextmanager
+    def profile(self, name: str):
+        """Profile the enclosed block and helper threads that call attach_thread()."""
+        session = self.start(name)
+        token = current_session.set(session)
+        try:
+            yield session
+        finally:
+            current_session.reset(token)
+            self.stop(session)
+
+    @contextmanager
+    def profile_job(self, job_id: str):
+        if not self.wants_job(job_id):
+            yield None
+            return
+        with self.profile(f"job-{job_id}") as session:
+            yield session
+
+    def _sample_loop(self):
+        last = time.monotonic()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                sessions = list(self._sessions)
+                if not sessions:
+                    self._sampler = None
+                    return
+            now = time.monotonic()
+            elapsed_us = int((now - last) * 1_000_000)
+            last = now
+            frames = sys._current_frames()
+            for session in sessions:
+                session.sample(frames, elapsed_us)
+            del frames
+
+    def _write(self, session: ProfileSession) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(session.started))
+        millis = int(session.started * 1000) % 1000
+        safe_name = re.sub(r"[^\w.-]", "_", session.name)
+        # Sessions of one route can start in the same millisecond
+        base = os.path.join(
+            self.output_dir, f"{stamp}.{millis:03d}-{safe_name}-{uuid.uuid4().hex[:6]}"
+        )
+        for kind, stacks in (("wall", session.wall), ("cpu", session.cpu)):
+            with open(f"{base}.{kind}.folded", "w", encoding="utf-8") as f:
+                for stack, weight in stacks.most_common():
+                    if weight:
+                        f.write(f"{stack} {weight}\n")
+        duration = time.time() - session.started
+        self.recent.append(
+            {
+                "name": session.name,
+                "started": session.started,
+                "seconds": round(duration, 3),
+                "samples": session.samples,
+                "path": f"{base}.wall.folded",
+            }
+        )
+        logger.info(
+            f"Profile {session.name}: {session.samples} samples over "
+            f"{duration:.2f}s written to {base}.*.folded"
+        )
+        return f"{base}.wall.folded"
+
+
+@contextmanager
+def attach_thread():
+    """
+    Include the calling thread in the current context's profile session, if
+    any. Used by helper threads that run work on behalf of a request or job.
+    """
+    session = current_session.get()
+    if session is None:
+        yield
+        return
+    ident = threading.get_ident()
+    session.attach(ident)
+    try:
+        yield
+    finally:
+        session.detach(ident)
+
+
+def run_attached(fn, *args, **kwargs):
+    """Call fn inside attach_thread(); for use with Context.run on helper threads."""
+    with attach_thread():
+        return fn(*args, **kwargs)
@@ -0,0 +1,170 @@
+import threading
+import time
+from typing import List, Optional
+
+
+def split_test_error(error: str) -> List[str]:
+    """One entry per console message of a browser-test error, so repeats match."""
+    if error.startswith("JavaScript errors:\n"):
+        return [
+            f"JavaScript error: {line.strip()}"
+            for line in error.splitlines()[1:]
+            if line.strip()
+        ]
+    return [error]
+
+
+class RepairContext:
+    """
+    Per-job state carried across create_page attempts.
+
+    Keeps the last candidate, the best candidate seen so far, the structured
+    errors reported by the analyzer and the test runner, and a short history
+    of every attempt so later attempts can repair instead of regenerating.
+    """
+
+    def __init__(self, prompt: str, max_errors: int = 12):
+        self.prompt = prompt
+        self.max_errors = max_errors
+        self.started = time.monotonic()
+        self.attempts: List[dict] = []
+        self.errors: List[dict] = []
+        self.last_candidate: Optional[str] = None
+        self.best_candidate: Optional[str] = None
+        self.best_score: Optional[int] = None
+
+    @property
+    def has_candidate(self) -> bool:
+        return self.best_candidate is not None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def add_error(self, source: str, attempt: int, message: str):
+        """Record a structured error, skipping exact duplicates."""
+        message = (message or "").strip()
+        if not message:
+            return
+        for error in self.errors:
+            if error["source"] == source and error["message"] == message:
+                error["last_attempt"] = attempt
+                error["count"] += 1
+                return
+        self.errors.append(
+            {
+                "source": source,
+                "message": message,
+                "first_attempt": attempt,
+                "last_attempt": attempt,
+                "count": 1,
+            }
+        )
+        if len(self.errors) > self.max_errors:
+            self.errors = self.errors[-self.max_errors :]
+
+    def record_attempt(
+        self,
+        attempt: int,
+        mode: str,
+        candidate: Optional[str],
+        issues: Optional[List[str]] = None,
+        test_error: Optional[str] = None,
+        started: Optional[float] = None,
+    ):
+        """
+        Record the outcome of one attempt and update the best candidate.
+
+        Candidates are scored by the number of problems reported against
+        them (lower is better); on a tie the newer candidate wins because it
+        has already absorbed more repair feedback.
+        """
+        issues = issues or []
+        for issue in issues:
+            self.add_error("analysis", attempt, issue)
+        if test_error:
+            for message in split_test_error(test_error):
+                self.add_error("test", attempt, message)
+
+        score = len(issues) + (1 if test_error else 0)
+        self.attempts.append(
+            {
+                "attempt": attempt,
+                "mode": mode,
+                "issues": len(issues),
+                "test_error": test_error,
+                "score": score,
+                "duration": time.monotonic() - started if started else None,
+            }
+        )
+
+        if candidate:
+            self.last_candidate = candidate
+            if self.best_score is None or score <= self.best_score:
+                self.best_candidate = candidate
+                self.best_score = score
+
+    def error_summary(self) -> str:
+        """Format the accumulated errors as a numbered list for the repair prompt."""
+        if not self.errors:
+            return "None recorded."
+        lines = []
+        for i, error in enumerate(self.errors, 1):
+            seen = f" (seen {error['count']}x)" if error["count"] > 1 else ""
+            lines.append(f"{i}. [{error['source']}] {error['message']}{seen}")
+        return "\n".join(lines)
+
+    def history_summary(self) -> str:
+        """One line per previous attempt, oldest first."""
+        if not self.attempts:
+            return "No previous attempts."
+        lines = []
+        for entry in self.attempts:
+            outcome = (
+                "; ".join(split_test_error(entry["test_error"]))
+                if entry["test_error"]
+                else "passed browser test"
+            )
+            lines.append(
+                f"Attempt {entry['attempt'] + 1} ({entry['mode']}): "
+                f"{entry['issues']} analyzer issue(s); {outcome}"
+            )
+        return "\n".join(lines)
+
+
+class GenerationStats:
+    """Thread-safe counters for attempts per page and wall-clock per job."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.jobs = 0
+        self.successes = 0
+        self.failures = 0
+        self.success_attempts = 0
+        self.total_seconds = 0.0
+        self.last = None
+
+    def record(self, success: bool, attempts: int, seconds: float):
+        with self._lock:
+            self.jobs += 1
+            self.total_seconds += seconds
+            if success:
+                self.successes += 1
+                self.success_attempts += attempts
+            else:
+                self.failures += 1
+            self.last = {"success": success, "attempts": attempts, "seconds": seconds}
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "jobs": self.jobs,
+                "successes": self.successes,
+                "failures": self.failures,
+                "avg_attempts_per_success": (
+                    self.success_attempts / self.successes if self.successes else None
+                ),
+                "avg_seconds_per_job": (
+                    self.total_seconds / self.jobs if self.jobs else None
+                ),
+                "last": self.last,
+            }
@@ -0,0 +1,245 @@
+"""
+Re-run the browser test on every stored page, several browser sessions at
+a time, and write a CSV with the result per page. Failing (or missing)
+pages can be queued for regeneration from their original prompt.
+
+Pages are loaded through the running web app, as in generation:
+
+    python revalidate.py --sessions 6 --output revalidation.csv
+    python revalidate.py --requeue --rate 4
+
+The runtime performance budget is only checked with --perf: with several
+browsers on one machine, timings measure the contention as much as the page.
+
+Uses the same DDD_* settings as app.py to find the pages and metadata.
+"""
+
+import argparse
+import csv
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import httpx
+from dotenv import load_dotenv
+
+from log_pipeline import setup_logging
+from state_store import create_state_store
+from test_runner import PerformanceBudget, TestRunner
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ["page", "status", "error", "seconds", "prompt", "tested_at"]
+
+# TestRunner's prefix for performance budget failures
+PERF_ERROR = "Runtime performance:"
+
+
+class DriverPool:
+    """One reusable browser session per worker thread."""
+
+    def __init__(self, runner: TestRunner):
+        self.runner = runner
+        self._local = threading.local()
+        self._drivers = []
+        self._lock = threading.Lock()
+
+    def get(self):
+        driver = getattr(self._local, "driver", None)
+        if driver is not None:
+            try:
+                driver.current_url  # raises if the session died
+                return driver
+            except Exception:
+                logger.warning("Browser session lost, starting a new one")
+                self.discard(driver)
+        driver = self._local.driver = self.runner.new_driver()
+        with self._lock:
+            self._drivers.append(driver)
+        return driver
+
+    def discard(self, driver):
+        self._local.driver = None
+        with self._lock:
+            if driver in self._drivers:
+                self._drivers.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close(self):
+        with self._lock:
+            drivers, self._drivers = self._drivers, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception as e:
+                logger.error(f"Error quitting driver: {e}")
+
+
+def revalidate_page(state, runner: TestRunner, pool: DriverPool, name: str, info):
+    started = time.monotonic()
+    content = state.load_page(name) if state.page_exists(name) else None
+    if content is None:
+        success, error, status = False, "Page file not found", "missing"
+    else:
+        driver = None
+        try:
+            driver = pool.get()
+            success, error = runner.test_page(content, driver=driver)
+            status = "pass" if success else "fail"
+        except Exception as e:
+            # A browser that would not start or crashed says nothing about the page
+            logger.warning(f"Could not test {name}: {e}")
+            if driver is not None:
+                pool.discard(driver)
+            success, error, status = False, f"Test could not run: {e}", "error"
+    return {
+        "page": name,
+        "status": status,
+        "error": error or "",
+        "seconds": round(time.monotonic() - started, 2),
+        "prompt": (info or {}).get("prompt", ""),
+        "tested_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+def write_results(results, path: str):
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        writer.writerows(sorted(results, key=lambda r: r["page"]))
+
+
+def requeue(results, base_url: str, rate: float):
+    """
+    Submit failing pages' prompts to the web app, `rate` per minute at most.
+    Each new page replaces the failing one once it is saved.
+    Pages that only broke the performance budget, or could not be tested,
+    are not regenerated.
+    """
+    failed = [r for r in results if r["status"] in ("fail", "missing") and r["prompt"]]
+    to_requeue = [r for r in failed if not r["error"].startswith(PERF_ERROR)]
+    if len(to_requeue) < len(failed):
+        print(
+            f"Not re-queueing {len(failed) - len(to_requeue)} page(s) "
+            "that only failed the performance budget"
+        )
+    if not to_requeue:
+        return
+    print(f"Re-queueing {len(to_requeue)} page(s) at {rate:g} per minute")
+    with httpx.Client(base_url=base_url, timeout=30) as http:
+        for i, result in enumerate(to_requeue):
+            if i:
+                time.sleep(60 / rate)
+            try:
+                response = http.post(
+                    "/api/llm/generate",
+                    json={"prompt": result["prompt"], "replaces": result["page"]},
+                )
+                response.raise_for_status()
+                job_id = response.json()["job_id"]
+                print(f"  {result['page']} -> job {job_id}")
+            except (httpx.HTTPError, KeyError, ValueError) as e:
+                print(f"  {result['page']}: could not queue: {e}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Revalidate stored pages")
+    parser.add_argument(
+        "--sessions",
+        type=int,
+        default=4,
+        help="browser sessions (pages tested in parallel)",
+    )
+    parser.add_argument("--output", default="revalidation.csv")
+    parser.add_argument(
+        "--pages", nargs="*", help="only these page names (default: all)"
+    )
+    parser.add_argument(
+        "--base-url",
+        default=os.getenv("DDD_TEST_BASE_URL", "http://localhost:5000"),
+        help="web app that serves the pages and accepts prompts",
+    )
+    parser.add_argument(
+        "--requeue",
+        action="store_true",
+        help="regenerate failing and missing pages; each new page replaces the old one",
+    )
+    parser.add_argument(
+        "--rate", type=float, default=2, help="re-queued prompts per minute"
+    )
+    parser.add_argument(
+        "--perf",
+        action="store_true",
+        help="also check the runtime performance budget (DDD_PERF_BUDGET)",
+    )
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    setup_logging(level=logging.INFO)
+    args = parse_args()
+
+    app_dir = os.path.dirname(os.path.abspath(__file__))
+    state = create_state_store(
+        os.getenv("DDD_STATE_BACKEND", "local"),
+        os.getenv("DDD_PAGES_DIR", os.path.join(app_dir, "templates", "pages")),
+        "page_metadata.json",
+        os.getenv("DDD_STATE_DB", "state.sqlite3"),
+    )
+    runner = TestRunner(
+        pages_dir=state.pages_dir,
+        base_url=args.base_url,
+        performance=(
+            PerformanceBudget(**json.loads(os.getenv("DDD_PERF_BUDGET", "{}")))
+            if args.perf
+            else None
+        ),
+    )
+
+    page_info = state.all_page_info()
+    names = args.pages or sorted(set(state.list_pages()) | set(page_info))
+    print(f"Revalidating {len(names)} page(s) with {args.sessions} browser session(s)")
+
+    pool = DriverPool(runner)
+    results = []
+    sweep_started = time.monotonic()
+    try:
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            futures = [
+                executor.submit(
+                    revalidate_page, state, runner, pool, name, page_info.get(name)
+                )
+                for name in names
+            ]
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                print(
+                    f"[{len(results)}/{len(names)}] {result['status']:<7} "
+                    f"{result['page']} ({result['seconds']}s) {result['error'][:80]}"
+                )
+    finally:
+        pool.close()
+        # Keep what was tested even if the sweep was interrupted
+        write_results(results, args.output)
+
+    counts = {
+        s: sum(r["status"] == s for r in results)
+        for s in ("pass", "fail", "missing", "error")
+    }
+    print(
+        f"\n{counts['pass']} passed, {counts['fail']} failed, {counts['missing']} missing, "
+        f"{counts['error']} not tested in {time.monotonic() - sweep_started:.1f}s; "
+        f"results in {args.output}"
+    )
+
+    if args.requeue:
+        requeue(results, args.base_url, args.rate)
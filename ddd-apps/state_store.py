@@ -0,0 +1,492 @@
+import copy
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class StateStore(ABC):
+    """
+    Interface for the state shared between web and worker processes:
+    the prompt queue, page metadata and generated page storage.
+
+    Queue items are JSON-serialisable dicts. Workers claim an item with a
+    lease; if the worker dies the lease expires and another worker picks
+    the item up again.
+    """
+
+    # Seconds a worker waits between polls of an empty queue
+    poll_interval = 0.1
+
+    # Job records kept for the jobs API; older ones are pruned
+    max_jobs = 500
+
+    def __init__(self, pages_dir: str):
+        self.pages_dir = pages_dir
+        os.makedirs(self.pages_dir, exist_ok=True)
+
+    # Queue
+
+    @abstractmethod
+    def enqueue(self, item: dict) -> str: ...
+
+    @abstractmethod
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Tuple[str, dict]]:
+        """Claim the next queued item; returns (item_id, item) or None."""
+
+    @abstractmethod
+    def renew_lease(
+        self, item_id: str, worker_id: str, lease_seconds: float
+    ) -> bool: ...
+
+    @abstractmethod
+    def complete(self, item_id: str, worker_id: str): ...
+
+    @abstractmethod
+    def queue_size(self) -> int: ...
+
+    @abstractmethod
+    def processing_count(self) -> int: ...
+
+    # Page metadata
+
+    @abstractmethod
+    def store_page_info(self, page_name: str, info: dict): ...
+
+    @abstractmethod
+    def get_page_info(self, page_name: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    def all_page_info(self) -> dict: ...
+
+    @abstractmethod
+    def delete_page_info(self, page_name: str): ...
+
+    # Job records
+
+    @abstractmethod
+    def save_job(self, job: dict): ...
+
+    @abstractmethod
+    def get_job(self, job_id: str) -> Optional[dict]: ...
+
+    @abstractmethod
+    def list_jobs(self, limit: int = 20, since: float = None) -> List[dict]:
+        """Most recently updated jobs first, optionally only those updated after `since`."""
+
+    @abstractmethod
+    def latest_job_update(self) -> Optional[float]: ...
+
+    @abstractmethod
+    def request_cancel(self, job_id: str):
+        """Flag a job for cancellation; the worker running it polls the flag."""
+
+    @abstractmethod
+    def is_cancel_requested(self, job_id: str) -> bool: ...
+
+    # Page storage
+
+    def page_path(self, page_name: str) -> str:
+        return os.path.join(self.pages_dir, f"{page_name}.html")
+
+    def save_page(self, page_name: str, content: str) -> str:
+        """Write a page atomically so concurrent readers never see half a file."""
+        page_path = self.page_path(page_name)
+        tmp_path = f"{page_path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_path, page_path)
+        return page_path
+
+    def load_page(self, page_name: str) -> Optional[str]:
+        page_path = self.page_path(page_name)
+        if not os.path.exists(page_path):
+            return None
+        with open(page_path, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def delete_page(self, page_name: str):
+        page_path = self.page_path(page_name)
+        if os.path.exists(page_path):
+            os.unlink(page_path)
+
+    def page_exists(self, page_name: str) -> bool:
+        return os.path.exists(self.page_path(page_name))
+
+    def list_pages(self) -> List[str]:
+        """Generated pages, excluding the temporary pages the test runner writes."""
+        return [
+            f[: -len(".html")]
+            for f in os.listdir(self.pages_dir)
+            if f.endswith(".html") and not f.startswith("test_")
+        ]
+
+
+class LocalStateStore(StateStore):
+    """
+    Single-process backend: an in-memory queue and the JSON metadata file.
+    This is the original behaviour and is not safe to share between processes.
+    """
+
+    def __init__(self, pages_dir: str, metadata_file: str):
+        super().__init__(pages_dir)
+        self.metadata_file = metadata_file
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._leases = {}  # item_id -> (worker_id, expires, item)
+        self._metadata = self._load_metadata()
+        self._jobs = OrderedDict()
+        self._cancelled = set()
+
+    def _load_metadata(self) -> dict:
+        if not os.path.exists(self.metadata_file):
+            return {}
+        with open(self.metadata_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save_metadata(self):
+        with open(self.metadata_file, "w", encoding="utf-8") as f:
+            json.dump(self._metadata, f, indent=4)
+
+    def _requeue_expired(self):
+        now = time.time()
+        for item_id, (_, expires, item) in list(self._leases.items()):
+            if expires < now:
+                logger.warning(f"Lease on queue item {item_id} expired, requeueing")
+                del self._leases[item_id]
+                self._queue.appendleft((item_id, item))
+
+    def enqueue(self, item: dict) -> str:
+        item_id = uuid.uuid4().hex
+        with self._lock:
+            self._queue.append((item_id, item))
+        return item_id
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Tuple[str, dict]]:
+        with self._lock:
+            self._requeue_expired()
+            if not self._queue:
+                return None
+            item_id, item = self._queue.popleft()
+            self._leases[item_id] = (worker_id, time.time() + lease_seconds, item)
+            return item_id, item
+
+    def renew_lease(self, item_id: str, worker_id: str, lease_seconds: float) -> bool:
+        with self._lock:
+            lease = self._leases.get(item_id)
+            if not lease or lease[0] != worker_id:
+                return False
+            self._leases[item_id] = (worker_id, time.time() + lease_seconds, lease[2])
+            return True
+
+    def complete(self, item_id: str, worker_id: str):
+        with self._lock:
+            lease = self._leases.get(item_id)
+            if lease and lease[0] == worker_id:
+                del self._leases[item_id]
+
+    def queue_size(self) -> int:
+        with self._lock:
+            return len(self._queue)
+
+    def processing_count(self) -> int:
+        with self._lock:
+            return len(self._leases)
+
+    def store_page_info(self, page_name: str, info: dict):
+        with self._lock:
+            self._metadata[page_name] = info
+            self._save_metadata()
+
+    def get_page_info(self, page_name: str) -> Optional[dict]:
+        with self._lock:
+            return self._metadata.get(page_name)
+
+    def all_page_info(self) -> dict:
+        with self._lock:
+            return dict(self._metadata)
+
+    def delete_page_info(self, page_name: str):
+        with self._lock:
+            if self._metadata.pop(page_name, None) is not None:
+                self._save_metadata()
+
+    def save_job(self, job: dict):
+        with self._lock:
+            self._jobs[job["id"]] = copy.deepcopy(job)
+            self._jobs.move_to_end(job["id"])
+            while len(self._jobs) > self.max_jobs:
+                evicted, _ = self._jobs.popitem(last=False)
+                self._cancelled.discard(evicted)
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return copy.deepcopy(job) if job else None
+
+    def list_jobs(self, limit: int = 20, since: float = None) -> List[dict]:
+        with self._lock:
+            jobs = [
+                copy.deepcopy(job)
+                for job in reversed(self._jobs.values())
+                if since is None or job["updated"] > since
+            ]
+        return jobs[:limit]
+
+    def latest_job_update(self) -> Optional[float]:
+        with self._lock:
+            if not self._jobs:
+                return None
+            return next(reversed(self._jobs.values()))["updated"]
+
+    def request_cancel(self, job_id: str):
+        with self._lock:
+            self._cancelled.add(job_id)
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        with self._lock:
+            return job_id in self._cancelled
+
+
+class SQLiteStateStore(StateStore):
+    """
+    Shared backend: queue and metadata in a SQLite database, pages as files
+    in a shared directory. Several processes on one host can point at the
+    same database and pages directory. The database uses WAL mode, which
+    needs shared memory, so it must not live on a network filesystem.
+    """
+
+    poll_interval = 0.5
+
+    def __init__(self, pages_dir: str, db_path: str, metadata_file: str = None):
+        super().__init__(pages_dir)
+        self.db_path = db_path
+        self._local = threading.local()
+        with self._transaction() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS queue (
+                    id TEXT PRIMARY KEY,
+                    item TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    lease_owner TEXT,
+                    lease_expires REAL,
+                    created REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS queue_state ON queue (state, created)"
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS page_metadata (
+                    name TEXT PRIMARY KEY,
+                    info TEXT NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    updated REAL NOT NULL,
+                    job TEXT NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs (updated)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS cancellations (
+                    job_id TEXT PRIMARY KEY,
+                    requested REAL NOT NULL
+                )"""
+            )
+        if metadata_file:
+            self._import_metadata(metadata_file)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+
+    def _import_metadata(self, metadata_file: str):
+        """Seed an empty database from the single-process JSON metadata file."""
+        if not os.path.exists(metadata_file):
+            return
+        with self._transaction() as conn:
+            if conn.execute("SELECT COUNT(*) FROM page_metadata").fetchone()[0]:
+                return
+            with open(metadata_file, "r", encoding="utf-8") as f:
+                metadata = json.load(f)
+            conn.executemany(
+                "INSERT INTO page_metadata (name, info) VALUES (?, ?)",
+                [(name, json.dumps(info)) for name, info in metadata.items()],
+            )
+        logger.info(f"Imported {len(metadata)} page records from {metadata_file}")
+
+    def enqueue(self, item: dict) -> str:
+        item_id = uuid.uuid4().hex
+        self._conn().execute(
+            "INSERT INTO queue (id, item, created) VALUES (?, ?, ?)",
+            (item_id, json.dumps(item), time.time()),
+        )
+        return item_id
+
+    def claim(self, worker_id: str, lease_seconds: float) -> Optional[Tuple[str, dict]]:
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                """SELECT id, item FROM queue
+                   WHERE state = 'queued'
+                      OR (state = 'leased' AND lease_expires < ?)
+                   ORDER BY created LIMIT 1""",
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                """UPDATE queue SET state = 'leased', lease_owner = ?, lease_expires = ?
+                   WHERE id = ?""",
+                (worker_id, now + lease_seconds, row[0]),
+            )
+        return row[0], json.loads(row[1])
+
+    def renew_lease(self, item_id: str, worker_id: str, lease_seconds: float) -> bool:
+        cursor = self._conn().execute(
+            """UPDATE queue SET lease_expires = ?
+               WHERE id = ? AND state = 'leased' AND lease_owner = ?""",
+            (time.time() + lease_seconds, item_id, worker_id),
+        )
+        return cursor.rowcount == 1
+
+    def complete(self, item_id: str, worker_id: str):
+        self._conn().execute(
+            "DELETE FROM queue WHERE id = ? AND lease_owner = ?", (item_id, worker_id)
+        )
+
+    def queue_size(self) -> int:
+        return (
+            self._conn()
+            .execute(
+                """SELECT COUNT(*) FROM queue
+               WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?)""",
+                (time.time(),),
+            )
+            .fetchone()[0]
+        )
+
+    def processing_count(self) -> int:
+        return (
+            self._conn()
+            .execute(
+                "SELECT COUNT(*) FROM queue WHERE state = 'leased' AND lease_expires >= ?",
+                (time.time(),),
+            )
+            .fetchone()[0]
+        )
+
+    def store_page_info(self, page_name: str, info: dict):
+        self._conn().execute(
+            "INSERT OR REPLACE INTO page_metadata (name, info) VALUES (?, ?)",
+            (page_name, json.dumps(info)),
+        )
+
+    def get_page_info(self, page_name: str) -> Optional[dict]:
+        row = (
+            self._conn()
+            .execute("SELECT info FROM page_metadata WHERE name = ?", (page_name,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    def all_page_info(self) -> dict:
+        rows = self._conn().execute("SELECT name, info FROM page_metadata").fetchall()
+        return {name: json.loads(info) for name, info in rows}
+
+    def delete_page_info(self, page_name: str):
+        self._conn().execute("DELETE FROM page_metadata WHERE name = ?", (page_name,))
+
+    def save_job(self, job: dict):
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR REPLACE INTO jobs (id, updated, job) VALUES (?, ?, ?)",
+                (job["id"], job["updated"], json.dumps(job)),
+            )
+            if cursor.lastrowid % 50 == 0:
+                conn.execute(
+                    """DELETE FROM jobs WHERE id NOT IN
+                       (SELECT id FROM jobs ORDER BY updated DESC LIMIT ?)""",
+                    (self.max_jobs,),
+                )
+                # Cancellation flags go with the job records they belong to
+                conn.execute(
+                    "DELETE FROM cancellations WHERE job_id NOT IN (SELECT id FROM jobs)"
+                )
+
+    def get_job(self, job_id: str) -> Optional[dict]:
+        row = (
+            self._conn()
+            .execute("SELECT job FROM jobs WHERE id = ?", (job_id,))
+            .fetchone()
+        )
+        return json.loads(row[0]) if row else None
+
+    def list_jobs(self, limit: int = 20, since: float = None) -> List[dict]:
+        rows = (
+            self._conn()
+            .execute(
+                "SELECT job FROM jobs WHERE updated > ? ORDER BY updated DESC LIMIT ?",
+                (since if since is not None else -1, limit),
+            )
+            .fetchall()
+        )
+        return [json.loads(row[0]) for row in rows]
+
+    def latest_job_update(self) -> Optional[float]:
+        return self._conn().execute("SELECT MAX(updated) FROM jobs").fetchone()[0]
+
+    def request_cancel(self, job_id: str):
+        self._conn().execute(
+            "INSERT OR IGNORE INTO cancellations (job_id, requested) VALUES (?, ?)",
+            (job_id, time.time()),
+        )
+
+    def is_cancel_requested(self, job_id: str) -> bool:
+        row = (
+            self._conn()
+            .execute("SELECT 1 FROM cancellations WHERE job_id = ?", (job_id,))
+            .fetchone()
+        )
+        return row is not None
+
+
+def create_state_store(
+    backend: str, pages_dir: str, metadata_file: str, db_path: str
+) -> StateStore:
+    """Build the configured backend ('local' or 'sqlite')."""
+    backend = (backend or "local").lower()
+    if backend == "local":
+        return LocalStateStore(pages_dir, metadata_file)
+    if backend == "sqlite":
+        return SQLiteStateStore(pages_dir, db_path, metadata_file)
+    raise ValueError(f"Unknown state backend: {backend}")
@@ -1,18 +1,129 @@
+import json
 import logging
 import os
 import tempfile
 import time  # Add this
-import random  # Add this
+import uuid
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 from selenium.common.exceptions import TimeoutException
 
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# Installed before any page script runs, so early long tasks and shifts are seen
+PERFORMANCE_OBSERVER_JS = """
+window.__dddPerf = {longTasks: [], layoutShift: 0};
+try {
+    new PerformanceObserver(list => list.getEntries().forEach(
+        e => window.__dddPerf.longTasks.push(e.duration)
+    )).observe({type: 'longtask', buffered: true});
+    new PerformanceObserver(list => list.getEntries().forEach(e => {
+        if (!e.hadRecentInput) window.__dddPerf.layoutShift += e.value;
+    })).observe({type: 'layout-shift', buffered: true});
+} catch (e) {}
+"""
+
+COLLECT_PERFORMANCE_JS = """
+const nav = performance.getEntriesByType('navigation')[0];
+return {
+    loadMs: nav ? nav.loadEventEnd || nav.domContentLoadedEventEnd : null,
+    longTasks: (window.__dddPerf || {}).longTasks || [],
+    layoutShift: (window.__dddPerf || {}).layoutShift || 0
+};
+"""
+
+
+class PerformanceBudget:
+    """
+    Limits a page must stay within while it is observed after loading.
+    The window is an idle period: no input, so steady CPU use, heap growth
+    or new DOM nodes come from timers and animation loops the page runs.
+    """
+
+    def __init__(
+        self,
+        window_seconds: float = 3.0,
+        max_load_ms: float = 5000,
+        max_long_tasks: int = 5,
+        max_blocking_ms: float = 600,
+        max_cpu_busy: float = 0.5,
+        max_heap_growth_mb: float = 5.0,
+        max_dom_nodes: int = 5000,
+        max_node_growth: int = 500,
+        max_layout_shift: float = 0.25,
+    ):
+        self.window_seconds = window_seconds
+        self.max_load_ms = max_load_ms
+        self.max_long_tasks = max_long_tasks
+        self.max_blocking_ms = max_blocking_ms
+        self.max_cpu_busy = max_cpu_busy
+        self.max_heap_growth_mb = max_heap_growth_mb
+        self.max_dom_nodes = max_dom_nodes
+        self.max_node_growth = max_node_growth
+        self.max_layout_shift = max_layout_shift
+
+    def violations(self, metrics: dict) -> list:
+        """Repair-friendly descriptions of every limit the metrics exceed."""
+        found = []
+        window = metrics["window_seconds"]
+        if metrics["load_ms"] is not None and metrics["load_ms"] > self.max_load_ms:
+            found.append(
+                f"page took {metrics['load_ms']:.0f}ms to load (limit "
+                f"{self.max_load_ms:.0f}ms) - do less work before the load event"
+            )
+        if (
+            metrics["long_tasks"] > self.max_long_tasks
+            or metrics["blocking_ms"] > self.max_blocking_ms
+        ):
+            found.append(
+                f"{metrics['long_tasks']} long tasks blocked the main thread for "
+                f"{metrics['blocking_ms']:.0f}ms (limits {self.max_long_tasks} tasks, "
+                f"{self.max_blocking_ms:.0f}ms) - split heavy loops into smaller "
+                "chunks and avoid synchronous work on load"
+            )
+        if metrics["cpu_busy"] > self.max_cpu_busy:
+            found.append(
+                f"main thread was busy {metrics['cpu_busy']:.0%} of a {window:.1f}s "
+                f"idle period (limit {self.max_cpu_busy:.0%}) - stop or throttle "
+                "setInterval/requestAnimationFrame loops when nothing changes"
+            )
+        if metrics["heap_growth_mb"] > self.max_heap_growth_mb:
+            found.append(
+                f"JS heap grew {metrics['heap_growth_mb']:.1f}MB in {window:.1f}s "
+                f"while idle (limit {self.max_heap_growth_mb:.1f}MB) - a timer or "
+                "loop keeps allocating; reuse objects and clear intervals"
+            )
+        if metrics["dom_nodes"] > self.max_dom_nodes:
+            found.append(
+                f"page has {metrics['dom_nodes']} DOM nodes (limit "
+                f"{self.max_dom_nodes}) - render fewer elements or paginate"
+            )
+        if metrics["node_growth"] > self.max_node_growth:
+            found.append(
+                f"{metrics['node_growth']} DOM nodes were added in {window:.1f}s "
+                f"while idle (limit {self.max_node_growth}) - a timer keeps "
+                "appending elements; update existing ones or remove old ones"
+            )
+        if metrics["layout_shift"] > self.max_layout_shift:
+            found.append(
+                f"cumulative layout shift {metrics['layout_shift']:.2f} (limit "
+                f"{self.max_layout_shift:.2f}) - reserve space for content that "
+                "loads later and give images/containers fixed sizes"
+            )
+        return found
+
 
 class TestRunner:
-    def __init__(self):
+    def __init__(
+        self,
+        pages_dir: str = None,
+        base_url: str = "http://localhost:5000",
+        performance: PerformanceBudget = None,
+    ):
+        self.pages_dir = pages_dir or os.path.join(os.getcwd(), "templates", "pages")
+        self.base_url = base_url.rstrip("/")
+        # None disables the runtime performance check
+        self.performance = performance
         self.chrome_options = Options()
         self.chrome_options.add_argument("--headless")
         self.chrome_options.add_argument("--no-sandbox")
@@ -21,31 +132,66 @@ class TestRunner:
         self.chrome_options.add_argument("--window-size=1920,1080")
         self.chrome_options.add_argument("--log-level=DEBUG")
 
-    def test_page(self, content: str) -> (bool, str):
+    def new_driver(self):
+        """Start a headless Chrome session set up for test_page()."""
+        driver = webdriver.Chrome(options=self.chrome_options)
+        if self.performance:
+            driver.execute_cdp_cmd(
+                "Page.addScriptToEvaluateOnNewDocument",
+                {"source": PERFORMANCE_OBSERVER_JS},
+            )
+            driver.execute_cdp_cmd("Performance.enable", {})
+        return driver
+
+    def test_page(
+        self,
+        content: str,
+        timeout: float = None,
+        on_cancel=None,
+        driver=None,
+        check_performance: bool = True,
+    ) -> (bool, str):
+        """
+        Load the page in headless Chrome and check it for structural and
+        console errors and, with a performance budget, runtime behaviour.
+
+        timeout bounds the page load and scripts in seconds. on_cancel, if
+        given, is called with a function that aborts the browser session and
+        must return a function that unregisters it again. A driver from
+        new_driver() is reused and left open; otherwise one is started and
+        quit for this page. check_performance=False skips the budget check.
+        """
         if not content or not content.strip():
             return False, "Empty content provided"
+        if timeout is not None and timeout <= 0:
+            return False, "No time left to run the browser test"
 
-        driver = None
+        own_driver = driver is None
         test_page_path = None
+        remove_cancel = None
         try:
             # Create a temporary page name for testing
-            test_page_name = f"test_{int(time.time())}_{random.randint(1000, 9999)}"
-            pages_dir = os.path.join(os.getcwd(), "templates", "pages")
-            if not os.path.exists(pages_dir):
-                os.makedirs(pages_dir)
+            test_page_name = f"test_{uuid.uuid4().hex}"
+            if not os.path.exists(self.pages_dir):
+                os.makedirs(self.pages_dir)
 
             # Save the test page
-            test_page_path = os.path.join(pages_dir, f"{test_page_name}.html")
+            test_page_path = os.path.join(self.pages_dir, f"{test_page_name}.html")
             with open(test_page_path, "w", encoding="utf-8") as f:
                 f.write(content)
             logger.debug(f"Created temporary page: {test_page_path}")
 
             # Initialize the Chrome driver in headless mode
-            driver = webdriver.Chrome(options=self.chrome_options)
-            driver.set_script_timeout(10)
+            if own_driver:
+                driver = self.new_driver()
+            if on_cancel:
+                remove_cancel = on_cancel(driver.quit)
+            driver.set_script_timeout(min(10, timeout) if timeout else 10)
+            driver.set_page_load_timeout(timeout or 300)
+            started = time.monotonic()
 
             # Load the page through the Flask server
-            driver.get(f"http://localhost:5000/pages/{test_page_name}")
+            driver.get(f"{self.base_url}/pages/{test_page_name}")
             # Implicitly wait to ensure the page has time to load
             driver.implicitly_wait(10)
 
@@ -77,12 +223,34 @@ class TestRunner:
                 logger.debug("Missing viewport meta tag.")
                 return False, "Missing viewport meta tag"
 
+            # Watch the page for a while; errors its timers log count below
+            metrics = None
+            if self.performance and check_performance:
+                window = self.performance.window_seconds
+                if timeout:
+                    window = min(window, timeout - (time.monotonic() - started) - 1)
+                if window > 0:
+                    metrics = self._measure(driver, window)
+                    logger.debug(f"Runtime metrics: {json.dumps(metrics)}")
+
             # Check for JavaScript errors in the console
             logs = driver.get_log("browser")
             errors = [log for log in logs if log["level"].upper() == "SEVERE"]
             if errors:
                 logger.debug(f"JavaScript errors: {errors}")
-                return False, f"JavaScript errors: {errors}"
+                # Message text only: timestamps and the temporary page URL
+                # change on every run and would defeat de-duplication
+                page_url = f"{self.base_url}/pages/{test_page_name}"
+                messages = dict.fromkeys(
+                    log["message"].replace(page_url, "page") for log in errors
+                )
+                return False, "JavaScript errors:\n" + "\n".join(messages)
+
+            if metrics:
+                violations = self.performance.violations(metrics)
+                if violations:
+                    logger.debug(f"Performance budget exceeded: {violations}")
+                    return False, "Runtime performance: " + "; ".join(violations)
 
             # Everything passed
             logger.debug("Page passed all tests.")
@@ -95,14 +263,51 @@ class TestRunner:
             logger.error(f"Test error: {str(e)}")
             return False, str(e)
         finally:
-            if driver:
+            if remove_cancel:
+                remove_cancel()
+            if own_driver and driver:
                 try:
                     driver.quit()
                 except Exception as e:
                     logger.error(f"Error quitting driver: {e}")
+            elif driver:
+                # Stop the page's timers and drop its log before the next page
+                try:
+                    driver.get("about:blank")
+                    driver.get_log("browser")
+                except Exception as e:
+                    logger.debug(f"Error resetting driver: {e}")
             if test_page_path and os.path.exists(test_page_path):
                 try:
                     os.unlink(test_page_path)
                     logger.debug(f"Deleted temporary page: {test_page_path}")
                 except Exception as e:
                     logger.error(f"Error deleting temporary page {test_page_path}: {e}")
+
+    def _measure(self, driver, window: float) -> dict:
+        """Sample runtime metrics after load and again after `window` seconds."""
+
+        def snapshot():
+            # Collect garbage first so heap growth means retained memory
+            driver.execute_cdp_cmd("HeapProfiler.collectGarbage", {})
+            result = driver.execute_cdp_cmd("Performance.getMetrics", {})
+            return {m["name"]: m["value"] for m in result["metrics"]}
+
+        before = snapshot()
+        time.sleep(window)
+        after = snapshot()
+        observed = driver.execute_script(COLLECT_PERFORMANCE_JS)
+        long_tasks = observed["longTasks"]
+        return {
+            "window_seconds": window,
+            "load_ms": observed["loadMs"],
+            "long_tasks": len(long_tasks),
+            # Total blocking time: the part of each long task over 50ms
+            "blocking_ms": sum(max(0, d - 50) for d in long_tasks),
+            "cpu_busy": (after["TaskDuration"] - before["TaskDuration"]) / window,
+            "heap_growth_mb": (after["JSHeapUsedSize"] - before["JSHeapUsedSize"])
+            / 1024**2,
+            "dom_nodes": int(after["Nodes"]),
+            "node_growth": int(after["Nodes"] - before["Nodes"]),
+            "layout_shift": observed["layoutShift"],
+        }